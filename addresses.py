@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Street address assembly and cleanup shared by the map scripts.
+
+``normalize_street_address`` keeps only the part of an address before the
+first comma, title-cases it, and upper-cases common street-type
+abbreviations ("Mission St" -> "Mission ST"). It works on a whole column with
+pandas string methods and a single compiled regex, so no Python function runs
+per row.
+
+It produces exactly what the old per-row ``format_address`` in
+``sf_311_maps.py`` did, including its quirks. The abbreviation match has no
+word boundary, so "Street" becomes "STreet". Non-string values pass through
+untouched.
+
+``join_address_parts`` builds an address from separate number/name/suffix
+columns. It joins whole columns at once and skips nulls and "Not Available"
+placeholders, matching the old row-wise ``create_address`` in
+``sf_building_permits_maps.py``.
+"""
+from __future__ import annotations
+
+import re
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+STREET_ABBREVIATIONS = ("St", "Ave", "Blvd", "Rd", "Dr", "Ln", "Ct", "Pl", "Hwy")
+
+_ABBREVIATION_RE = re.compile(r" (" + "|".join(STREET_ABBREVIATIONS) + r")")
+
+
+def _upper_abbreviation(match: re.Match) -> str:
+    return " " + match.group(1).upper()
+
+
+def normalize_street_address(addresses: pd.Series) -> pd.Series:
+    """Return ``addresses`` reduced to a title-cased street line."""
+    is_text = addresses.map(lambda value: isinstance(value, str))
+    if not is_text.any():
+        return addresses
+
+    text = addresses[is_text].astype(str)
+    street = text.str.split(",", n=1).str[0].str.strip().str.title()
+    street = street.str.replace(_ABBREVIATION_RE, _upper_abbreviation, regex=True)
+
+    result = addresses.astype(object).copy()
+    result[is_text] = street
+    return result
+
+
+def join_address_parts(frame: pd.DataFrame, columns: Sequence[str], missing: str = "Not Available",
+                       default: str = "Address Unknown") -> pd.Series:
+    """Space-join ``columns`` row by row, skipping absent, null and ``missing`` parts."""
+    joined = pd.Series("", index=frame.index, dtype=object)
+    has_part = pd.Series(False, index=frame.index)
+    for column in columns:
+        if column not in frame.columns:
+            continue
+        values = frame[column]
+        present = values.notna() & (values != missing)
+        if not present.any():
+            continue
+        text = values[present].astype(str)
+        joined[present] = np.where(has_part[present], joined[present] + " " + text, text)
+        has_part |= present
+    joined[~has_part] = default
+    return joined
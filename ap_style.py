@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""AP Style date formatting shared by every chart and map script.
+
+Scalar helpers format a single ``datetime`` for intros and notes:
+
+- ``format_date_ap_style``: "Jan. 2, 2025" or "March 15, 2025"
+- ``format_date_range_ap_style``: "Jan. 15-21, 2025" or "Jan. 28 - Feb. 3, 2025"
+- ``format_datetime_ap_style``: "Jan. 2, 2025, 1:38 p.m." or "March 15, 2025, noon"
+
+``ap_date_column`` and ``ap_datetime_column`` produce the same strings for a
+whole datetime column at once. They build each part from the ``.dt``
+components instead of calling the scalar helper per row. ``NaT`` values come
+back as ``NaN``.
+"""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+# AP abbreviates every month except March through July
+AP_MONTHS = {
+    1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
+    7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
+}
+
+
+def format_date_ap_style(dt):
+    """
+    Format a datetime object in AP Style (date only).
+    - Abbreviated months with periods (except March, April, May, June, July)
+    - No leading zeros on days
+    - Format: "Jan. 2, 2025" or "March 15, 2025"
+    """
+    return f"{AP_MONTHS[dt.month]} {dt.day}, {dt.year}"
+
+
+def format_date_range_ap_style(start_dt, end_dt):
+    """
+    Format a date range in AP Style.
+    - If same month: "Jan. 15-21, 2025"
+    - If different months: "Jan. 28 - Feb. 3, 2025"
+    """
+    if start_dt.month == end_dt.month and start_dt.year == end_dt.year:
+        return f"{AP_MONTHS[start_dt.month]} {start_dt.day}-{end_dt.day}, {end_dt.year}"
+    return f"{AP_MONTHS[start_dt.month]} {start_dt.day} - {AP_MONTHS[end_dt.month]} {end_dt.day}, {end_dt.year}"
+
+
+def _ap_time(hour: int, minute: int) -> str:
+    if hour == 0 and minute == 0:
+        return "midnight"
+    if hour == 12 and minute == 0:
+        return "noon"
+    hour_12 = hour % 12 or 12
+    ampm = "a.m." if hour < 12 else "p.m."
+    if minute == 0:
+        return f"{hour_12} {ampm}"
+    return f"{hour_12}:{minute:02d} {ampm}"
+
+
+def format_datetime_ap_style(dt):
+    """
+    Format a datetime object in AP Style (date and time).
+    - AP Style time: lowercase a.m./p.m., no leading zeros, noon/midnight for 12:00
+    - Format: "Jan. 2, 2025, 1:38 p.m." or "March 15, 2025, noon"
+    """
+    return f"{format_date_ap_style(dt)}, {_ap_time(dt.hour, dt.minute)}"
+
+
+def _date_parts(dt: pd.Series) -> pd.Series:
+    return dt.dt.month.map(AP_MONTHS) + " " + dt.dt.day.astype(str) + ", " + dt.dt.year.astype(str)
+
+
+def ap_date_column(values: pd.Series) -> pd.Series:
+    """Vectorized ``format_date_ap_style`` for a datetime column."""
+    valid = values.notna()
+    result = pd.Series(np.nan, index=values.index, dtype=object)
+    if valid.any():
+        result[valid] = _date_parts(values[valid])
+    return result
+
+
+def ap_datetime_column(values: pd.Series) -> pd.Series:
+    """Vectorized ``format_datetime_ap_style`` for a datetime column."""
+    valid = values.notna()
+    result = pd.Series(np.nan, index=values.index, dtype=object)
+    if not valid.any():
+        return result
+
+    dt = values[valid]
+    hour = dt.dt.hour
+    minute = dt.dt.minute
+    hour_12 = (hour % 12).replace(0, 12).astype(str)
+    ampm = pd.Series(np.where(hour < 12, "a.m.", "p.m."), index=dt.index)
+    clock = pd.Series(
+        np.where(minute == 0, hour_12 + " " + ampm, hour_12 + ":" + minute.astype(str).str.zfill(2) + " " + ampm),
+        index=dt.index,
+    )
+    time_str = pd.Series(
+        np.select([(hour == 0) & (minute == 0), (hour == 12) & (minute == 0)], ["midnight", "noon"], default=clock),
+        index=dt.index,
+    )
+    result[valid] = _date_parts(dt) + ", " + time_str
+    return result
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Classify registered business locations as openings or relocations.
+
+A location whose ``location_start_date`` falls on the same calendar day as the
+business's ``dba_start_date`` is a new business. A location that started
+after the business did is a relocation. Anything else, including rows missing
+either date, is unknown.
+
+``classify_business_activity`` works on whole datetime64 columns: both dates
+are normalized to midnight and compared with ``np.select``. The map uses it to
+label each point. A chart that fetches row-level location records can use it to
+split openings from relocations in the frame it already has, with no extra
+query.
+"""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+NEW_BUSINESS = "New Business"
+RELOCATION = "Business Relocation"
+UNKNOWN = "Unknown"
+
+ACTIVITY_TYPES = (NEW_BUSINESS, RELOCATION, UNKNOWN)
+
+
+def classify_business_activity(location_start: pd.Series, business_start: pd.Series) -> pd.Series:
+    """Label each row New Business, Business Relocation or Unknown."""
+    location_start = pd.to_datetime(location_start)
+    business_start = pd.to_datetime(business_start)
+    missing = location_start.isna() | business_start.isna()
+    same_day = location_start.dt.normalize() == business_start.dt.normalize()
+    moved = business_start < location_start
+    labels = np.select([missing, same_day, moved], [UNKNOWN, NEW_BUSINESS, RELOCATION], default=UNKNOWN)
+    return pd.Series(labels, index=location_start.index, dtype=object)
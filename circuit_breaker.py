@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Per-host circuit breakers shared by every pipeline and map script.
+
+Each upstream host (``data.sfgov.org``, ``api.datawrapper.de``) gets one
+breaker. After ``CIRCUIT_FAILURE_THRESHOLD`` consecutive outage-type failures
+the breaker trips (state ``open``) and every further call fails fast with
+:class:`CircuitOpenError` instead of waiting on another timeout. Once
+``CIRCUIT_RESET_SECONDS`` have passed, a single probe call is let through
+(state ``half_open``); success closes the breaker, failure re-opens it.
+
+The scripts run as separate processes (see ``run_all_updates.py``), so breaker
+state is persisted to ``state/circuit_breakers.json``. A host that tripped in
+the 911 maps run is still open when the 311 maps run starts a minute later.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+
+BASE_DIR = Path(__file__).resolve().parent
+STATE_DIR = BASE_DIR / "state"
+STATE_FILE = STATE_DIR / "circuit_breakers.json"
+
+FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "3"))
+RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", "120"))
+
+SOCRATA_HOST = "data.sfgov.org"
+DATAWRAPPER_HOST = "api.datawrapper.de"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+logger = logging.getLogger(__name__)
+
+_STATUS_IN_MESSAGE = re.compile(r"status code (\d{3})")
+_file_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream host whose breaker is open."""
+
+    def __init__(self, host: str, retry_in: float):
+        self.host = host
+        self.retry_in = retry_in
+        super().__init__(f"Circuit open for {host}; next probe in {retry_in:.0f}s")
+
+
+def is_outage(exc: BaseException) -> bool:
+    """Return True if ``exc`` looks like the host is down rather than a bad request.
+
+    Connection errors, timeouts, HTTP 5xx and 429 count against the breaker.
+    Other 4xx responses (bad SoQL, unknown chart ID) are our fault and do not.
+    """
+    if isinstance(exc, CircuitOpenError):
+        return False
+    status = None
+    response = getattr(exc, "response", None)
+    if response is not None:
+        status = getattr(response, "status_code", None)
+    if status is None:
+        # datawrapper.exceptions.FailedRequestError only keeps the code in its message
+        match = _STATUS_IN_MESSAGE.search(str(exc))
+        if match:
+            status = int(match.group(1))
+    if status is None:
+        return True
+    return status >= 500 or status == 429
+
+
+@dataclass
+class BreakerState:
+    state: str = CLOSED
+    consecutive_failures: int = 0
+    opened_at: Optional[float] = None
+    trips: int = 0  # times the breaker opened during the current run
+    fast_failures: int = 0  # calls rejected without touching the network
+
+
+def _read_states() -> Dict[str, Dict[str, Any]]:
+    if not STATE_FILE.exists():
+        return {}
+    try:
+        return json.loads(STATE_FILE.read_text())
+    except Exception as exc:  # pragma: no cover - defensive guard
+        logger.warning("Could not read circuit breaker state (%s); starting fresh", exc)
+        return {}
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker for a single upstream host."""
+
+    def __init__(self, host: str, failure_threshold: int = FAILURE_THRESHOLD,
+                 reset_timeout: float = RESET_SECONDS):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._probe_in_flight = False
+        stored = _read_states().get(host)
+        self._state = BreakerState(**stored) if stored else BreakerState()
+
+    @property
+    def state(self) -> str:
+        return self._state.state
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"host": self.host, **asdict(self._state)}
+
+    def _save(self) -> None:
+        with _file_lock:
+            STATE_DIR.mkdir(parents=True, exist_ok=True)
+            states = _read_states()
+            states[self.host] = asdict(self._state)
+            STATE_FILE.write_text(json.dumps(states, indent=2))
+
+    def before_call(self) -> None:
+        """Raise :class:`CircuitOpenError` unless a call may go through now."""
+        with self._lock:
+            if self._state.state == CLOSED:
+                return
+            elapsed = time.time() - (self._state.opened_at or 0)
+            if self._state.state == OPEN and elapsed >= self.reset_timeout:
+                self._state.state = HALF_OPEN
+                logger.info("Circuit for %s half-open; sending probe request", self.host)
+            if self._state.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self._state.fast_failures += 1
+            retry_in = max(self.reset_timeout - elapsed, 0)
+        raise CircuitOpenError(self.host, retry_in)
+
+    def record_success(self) -> None:
+        with self._lock:
+            changed = self._state.state != CLOSED or self._state.consecutive_failures
+            if self._state.state != CLOSED:
+                logger.info("Circuit for %s closed; host has recovered", self.host)
+            self._state.state = CLOSED
+            self._state.consecutive_failures = 0
+            self._state.opened_at = None
+            self._probe_in_flight = False
+        if changed:
+            self._save()
+
+    def record_failure(self, exc: BaseException) -> None:
+        if not is_outage(exc):
+            # The host answered; a bad request says nothing about its health.
+            self.record_success()
+            return
+        with self._lock:
+            self._state.consecutive_failures += 1
+            probe_failed = self._state.state == HALF_OPEN
+            self._probe_in_flight = False
+            if probe_failed or self._state.consecutive_failures >= self.failure_threshold:
+                if self._state.state != OPEN:
+                    self._state.trips += 1
+                self._state.state = OPEN
+                self._state.opened_at = time.time()
+                logger.warning(
+                    "Circuit for %s OPEN after %d consecutive failures (%s)",
+                    self.host, self._state.consecutive_failures, exc,
+                )
+        self._save()
+
+    def call(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run ``func`` through the breaker, recording its outcome."""
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            self.record_failure(exc)
+            raise
+        self.record_success()
+        return result
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(host: str) -> CircuitBreaker:
+    """Return the process-wide breaker for ``host``."""
+    with _registry_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+class GuardedClient:
+    """Proxy that routes every method call on an API client through a breaker.
+
+    If a ``rate_limiter`` (anything with an ``acquire()`` method) is given, it
+    is awaited before each call that the breaker lets through.
+    """
+
+    def __init__(self, client: Any, host: str, rate_limiter: Any = None):
+        self._client = client
+        self._breaker = get_breaker(host)
+        self._rate_limiter = rate_limiter
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def guarded(*args: Any, **kwargs: Any) -> Any:
+            return self._breaker.call(self._throttled, attr, *args, **kwargs)
+
+        return guarded
+
+    def _throttled(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire()
+        return func(*args, **kwargs)
+
+
+def guard(client: Any, host: str, rate_limiter: Any = None) -> GuardedClient:
+    """Wrap a Socrata or Datawrapper client so its calls respect ``host``'s breaker."""
+    return GuardedClient(client, host, rate_limiter)
+
+
+def summary() -> List[Dict[str, Any]]:
+    """Persisted state of every known breaker, including other processes' hosts."""
+    states = _read_states()
+    for host, breaker in _breakers.items():
+        states[host] = {k: v for k, v in breaker.snapshot().items() if k != "host"}
+    return [{"host": host, **state} for host, state in sorted(states.items())]
+
+
+def log_summary(log: logging.Logger = logger) -> None:
+    for entry in summary():
+        log.info(
+            "Circuit %s: %s (trips this run: %d, fast failures: %d)",
+            entry["host"], entry["state"].upper(), entry["trips"], entry["fast_failures"],
+        )
+
+
+def reset_run_counters() -> None:
+    """Zero the per-run trip counters while keeping open/closed state."""
+    with _file_lock:
+        states = _read_states()
+        if not states:
+            return
+        for state in states.values():
+            state["trips"] = 0
+            state["fast_failures"] = 0
+        STATE_FILE.write_text(json.dumps(states, indent=2))
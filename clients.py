@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Thread-safe registry of Socrata and Datawrapper API clients.
+
+Scripts used to build global ``dw`` and ``client`` objects at import time and
+share them between every function. This module replaces those globals:
+
+- ``get_socrata()`` and ``get_datawrapper()`` return a client owned by the
+  calling thread. Each one is created lazily on first use and wrapped in the
+  host's circuit breaker (see ``circuit_breaker.py``).
+- ``get_session(host)`` returns a per-thread ``requests.Session`` for raw API
+  calls, such as the CSV upload to Datawrapper.
+- ``datawrapper_rate_limiter()`` spaces every Datawrapper call in the process,
+  client or raw, to ``DATAWRAPPER_REQUESTS_PER_SECOND`` (default 10).
+
+Sessions belong to one thread, but they all mount a single ``HTTPAdapter`` per
+host. Threads therefore share that host's urllib3 connection pool and never
+share session state such as headers, cookies or auth.
+
+Socrata portals are configured per domain in ``SOCRATA_DOMAINS``: each domain
+gets its own connection pool, rate limiter and app token. ``run_per_domain``
+runs configs for different domains concurrently, one thread per portal, so
+adding a portal adds throughput instead of serial minutes.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Mapping, Tuple
+
+import datawrapper
+import requests
+from requests.adapters import HTTPAdapter
+from sodapy import Socrata
+
+from circuit_breaker import DATAWRAPPER_HOST, SOCRATA_HOST, GuardedClient, guard
+
+# API Credentials
+DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
+DATASF_APP_TOKEN = os.environ.get("DATASF_APP_TOKEN", "xdboBmIBQtjISZqIRYDWjKyxY")
+
+# Max pooled connections kept open per host, shared by all threads
+POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+
+# Socrata portals we query. app_token_env names the environment variable that
+# holds the portal's app token; requests_per_second caps our request rate.
+# Unlisted domains fall back to DATASF_APP_TOKEN (Socrata tokens work on any
+# portal) and the default rate.
+DEFAULT_SOCRATA_RPS = float(os.environ.get("SOCRATA_REQUESTS_PER_SECOND", "5"))
+SOCRATA_DOMAINS: Dict[str, Dict[str, Any]] = {
+    "data.sfgov.org": {"app_token_env": "DATASF_APP_TOKEN"},
+    "data.oaklandca.gov": {"app_token_env": "OAKLAND_APP_TOKEN"},
+    "data.smcgov.org": {"app_token_env": "SAN_MATEO_APP_TOKEN"},
+}
+
+# Cap on our Datawrapper request rate, shared by every thread that publishes
+DATAWRAPPER_RPS = float(os.environ.get("DATAWRAPPER_REQUESTS_PER_SECOND", "10"))
+
+_local = threading.local()
+_adapters: Dict[str, HTTPAdapter] = {}
+_adapters_lock = threading.Lock()
+_rate_limiters: Dict[str, "RateLimiter"] = {}
+_rate_limiters_lock = threading.Lock()
+_fetch_locks: Dict[str, threading.Lock] = {}
+_fetch_locks_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Spaces calls at least ``1 / rate`` seconds apart across all threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _shared_adapter(host: str) -> HTTPAdapter:
+    with _adapters_lock:
+        if host not in _adapters:
+            _adapters[host] = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        return _adapters[host]
+
+
+def _thread_cache() -> Dict[Tuple[str, str], Any]:
+    cache = getattr(_local, "clients", None)
+    if cache is None:
+        cache = _local.clients = {}
+    return cache
+
+
+def get_session(host: str) -> requests.Session:
+    """Return this thread's session for ``host``, backed by the shared pool."""
+    cache = _thread_cache()
+    key = ("session", host)
+    if key not in cache:
+        session = requests.Session()
+        session.mount(f"https://{host}", _shared_adapter(host))
+        cache[key] = session
+    return cache[key]
+
+
+def socrata_rate_limiter(domain: str) -> RateLimiter:
+    """Return the process-wide rate limiter for a Socrata ``domain``."""
+    with _rate_limiters_lock:
+        if domain not in _rate_limiters:
+            settings = SOCRATA_DOMAINS.get(domain, {})
+            _rate_limiters[domain] = RateLimiter(settings.get("requests_per_second", DEFAULT_SOCRATA_RPS))
+        return _rate_limiters[domain]
+
+
+def datawrapper_rate_limiter() -> RateLimiter:
+    """Return the process-wide rate limiter for Datawrapper API calls."""
+    with _rate_limiters_lock:
+        if DATAWRAPPER_HOST not in _rate_limiters:
+            _rate_limiters[DATAWRAPPER_HOST] = RateLimiter(DATAWRAPPER_RPS)
+        return _rate_limiters[DATAWRAPPER_HOST]
+
+
+def socrata_app_token(domain: str) -> str:
+    token_env = SOCRATA_DOMAINS.get(domain, {}).get("app_token_env")
+    return os.environ.get(token_env, DATASF_APP_TOKEN) if token_env else DATASF_APP_TOKEN
+
+
+def get_socrata(domain: str = SOCRATA_HOST) -> GuardedClient:
+    """Return this thread's Socrata client for ``domain``."""
+    cache = _thread_cache()
+    key = ("socrata", domain)
+    if key not in cache:
+        client = Socrata(
+            domain,
+            socrata_app_token(domain),
+            session_adapter={"prefix": "https://", "adapter": _shared_adapter(domain)},
+        )
+        cache[key] = guard(client, domain, socrata_rate_limiter(domain))
+    return cache[key]
+
+
+def config_domain(config: Mapping[str, Any]) -> str:
+    """Socrata domain a chart or map config queries (DataSF unless it says otherwise)."""
+    return config.get("domain", SOCRATA_HOST)
+
+
+def socrata_for(config: Mapping[str, Any]) -> GuardedClient:
+    """Return this thread's Socrata client for the config's domain."""
+    return get_socrata(config_domain(config))
+
+
+def fetch_lock(config: Mapping[str, Any]) -> threading.Lock:
+    """Lock held while fetching a config, so a portal sees one of our fetches at a time.
+
+    ``run_per_domain`` already serializes a domain's configs; this keeps that
+    guarantee when configs run concurrently (see ``transform_pool.run_configs``).
+    """
+    domain = config_domain(config)
+    with _fetch_locks_lock:
+        return _fetch_locks.setdefault(domain, threading.Lock())
+
+
+def run_per_domain(configs: Mapping[str, Mapping[str, Any]], func: Callable[[str], Any]) -> None:
+    """Call ``func(name)`` for every config, running each domain's configs concurrently.
+
+    Configs on the same domain still run one after another, in config order,
+    so a single portal never sees more than one of our fetches at a time.
+    """
+    by_domain: Dict[str, List[str]] = {}
+    for name, config in configs.items():
+        by_domain.setdefault(config_domain(config), []).append(name)
+
+    def run_domain(names: List[str]) -> None:
+        for name in names:
+            func(name)
+
+    if len(by_domain) <= 1:
+        for names in by_domain.values():
+            run_domain(names)
+        return
+
+    with ThreadPoolExecutor(max_workers=len(by_domain), thread_name_prefix="socrata") as pool:
+        futures = [pool.submit(run_domain, names) for names in by_domain.values()]
+        for future in futures:
+            future.result()
+
+
+def get_datawrapper() -> GuardedClient:
+    """Return this thread's Datawrapper client.
+
+    The datawrapper package issues requests through the module-level
+    ``requests`` API, so it cannot use the pooled session; raw calls that need
+    pooling should use ``get_session(DATAWRAPPER_HOST)``.
+    """
+    cache = _thread_cache()
+    key = ("datawrapper", DATAWRAPPER_HOST)
+    if key not in cache:
+        cache[key] = guard(
+            datawrapper.Datawrapper(access_token=DATAWRAPPER_API_KEY), DATAWRAPPER_HOST, datawrapper_rate_limiter()
+        )
+    return cache[key]
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Extract latitude and longitude from Socrata point columns.
+
+Socrata returns ``location`` columns as GeoJSON points,
+``{"type": "Point", "coordinates": [long, lat]}``. ``point_coordinates``
+reads each struct once and fills two float64 arrays. Missing or malformed
+points (None, strings, short coordinate lists, non-numeric values) become
+NaN together, so a later ``dropna`` removes them in bulk.
+"""
+from __future__ import annotations
+
+import math
+from typing import Any, Tuple
+
+import numpy as np
+import pandas as pd
+
+_MISSING = (math.nan, math.nan)
+
+
+def _long_lat(point: Any) -> Tuple[float, float]:
+    try:
+        coordinates = point["coordinates"]
+        return float(coordinates[0]), float(coordinates[1])
+    except (TypeError, KeyError, IndexError, ValueError):
+        return _MISSING
+
+
+def point_coordinates(locations: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Return ``(lat, long)`` float64 arrays for a column of GeoJSON points."""
+    pairs = np.array([_long_lat(point) for point in locations], dtype=np.float64).reshape(-1, 2)
+    return pairs[:, 1], pairs[:, 0]
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Compact dtypes for map frames.
+
+Socrata rows arrive as JSON strings, so every column starts as a Python
+``object`` column. Most of them don't need to be. Neighborhoods, districts,
+statuses and categories have a few dozen distinct values, and "hours ago"
+style durations are rounded to one decimal anyway.
+
+Coordinates stay float64. float32 keeps only about seven significant
+digits, so a longitude like -122.41xxxx moves by up to about 0.7 m, and the
+published CSV would no longer match the source data.
+
+Each map module gives its output columns one of the kinds below (the
+``dtype`` of a ``ColumnSpec``, see ``column_spec.py``). ``apply_dtype_plan``
+runs once the cleanup is done, and the compact frame is what gets carried to
+the Datawrapper upload. Columns the plan doesn't list, or that are missing,
+are left alone.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Mapping
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CATEGORY = "category"  # low-cardinality labels: neighborhood, district, status, ...
+TEXT = "string[pyarrow]"  # free text stored in Arrow buffers instead of Python objects
+COORDINATE = "float64"  # float32 shifts points by up to ~0.7 m in the CSV
+DURATION = "float32"
+COUNT = "int32"
+
+_NUMERIC = {COORDINATE, DURATION, COUNT}
+
+
+def apply_dtype_plan(df: pd.DataFrame, plan: Mapping[str, str]) -> pd.DataFrame:
+    """Convert ``df``'s columns to the dtypes in ``plan`` and log the memory saved."""
+    if df.empty:
+        return df
+    before = df.memory_usage(deep=True).sum()
+    # Shallow: converted columns replace their originals, the rest stay shared
+    df = df.copy(deep=False)
+    for column, kind in plan.items():
+        if column not in df.columns:
+            continue
+        if kind in _NUMERIC:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype(kind)
+        else:
+            df[column] = df[column].astype(kind)
+    after = df.memory_usage(deep=True).sum()
+    logger.info(
+        "Compacted %d rows from %.0f to %.0f bytes/row",
+        len(df), before / len(df), after / len(df),
+    )
+    return df
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Wait for a Socrata dataset to catch up before fetching it.
+
+The daily maps plot the most recent complete day, but they run at a fixed
+time. If DataSF has not loaded yesterday's records yet, we publish a stale
+day and need another full run to fix it. ``wait_for_fresh`` runs a cheap
+``MAX(<timestamp>)`` query on a backoff schedule until the data reaches past
+the expected day or the deadline passes. Only then does the caller start its
+heavy fetch.
+
+A single row from the expected day doesn't prove the day is loaded; DataSF
+loads a day in batches. The query takes the caller's filter (a 311 map's
+``service_filter``), since one fast-updating category would otherwise hide lag
+in the others. The data counts as fresh once the filtered rows reach the day
+after the expected one. It also counts as fresh once they reach the expected
+day and the dataset as a whole has rows from the day after, because a quiet
+service may have nothing after midnight yet.
+
+Fresh data runs into today, which is still partial, so callers map
+``day_to_map``: the newest day with data, but never later than the expected
+day.
+
+Each (dataset, filter) pair is polled at most once per process. All polls of
+a dataset share one deadline, ``FRESHNESS_DEADLINE_MINUTES`` (default 5) from
+the first check, so a run of maps on the same dataset never waits longer than
+that in total; 0 checks once without waiting. ``run_all_updates.py`` kills a
+script after 10 minutes, so keep the deadline well under that.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_SECONDS = float(os.environ.get("FRESHNESS_DEADLINE_MINUTES", "5")) * 60
+INITIAL_DELAY_SECONDS = 30.0
+MAX_DELAY_SECONDS = 120.0
+
+_results: Dict[Tuple[str, str, Optional[str], date], bool] = {}
+_deadlines: Dict[str, float] = {}
+_results_lock = threading.Lock()
+
+
+def expected_day(lag_days: int = 1) -> date:
+    """The newest day a daily dataset should be complete for (yesterday by default)."""
+    return (datetime.now() - timedelta(days=lag_days)).date()
+
+
+def day_to_map(latest: Optional[datetime], expected: date) -> date:
+    """The complete day to map: the newest day with data, capped at ``expected``."""
+    if latest is None:
+        return expected
+    return min(latest.date(), expected)
+
+
+def backoff_delays(initial: float = INITIAL_DELAY_SECONDS, maximum: float = MAX_DELAY_SECONDS) -> Iterator[float]:
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * 2, maximum)
+
+
+def latest_timestamp(client: Any, dataset_id: str, column: str, where: Optional[str] = None) -> Optional[datetime]:
+    """Return the newest value of ``column`` in the rows matching ``where``, or None if there are none."""
+    query = f"SELECT MAX({column}) AS latest"
+    if where:
+        query += f" WHERE {where}"
+    result = client.get(dataset_id, query=query)
+    if not result or not result[0].get("latest"):
+        return None
+    return datetime.fromisoformat(result[0]["latest"].split(".")[0])
+
+
+def wait_for_fresh(client: Any, dataset_id: str, column: str, expected: date,
+                   deadline_seconds: float = DEADLINE_SECONDS,
+                   sleep: Callable[[float], None] = time.sleep,
+                   where: Optional[str] = None) -> bool:
+    """Block until the rows of ``dataset_id`` matching ``where`` reach past ``expected``.
+
+    Returns True once the data is fresh, or False if the deadline passed or
+    the check itself failed. A False result never stops the caller; it just
+    proceeds with whatever data is there, as it did before polling existed.
+    """
+    key = (dataset_id, column, where, expected)
+    with _results_lock:
+        if key in _results:
+            return _results[key]
+        deadline = _deadlines.setdefault(dataset_id, time.monotonic() + deadline_seconds)
+
+    fresh = _poll(client, dataset_id, column, where, expected, deadline, sleep)
+    with _results_lock:
+        _results[key] = fresh
+    return fresh
+
+
+def _poll(client: Any, dataset_id: str, column: str, where: Optional[str], expected: date,
+          deadline: float, sleep: Callable[[float], None]) -> bool:
+    name = f"{dataset_id} ({where})" if where else dataset_id
+    delays = backoff_delays()
+    while True:
+        try:
+            latest = latest_timestamp(client, dataset_id, column, where)
+            # Rows from the following day mean the expected day is fully loaded
+            overall = latest
+            if where and latest is not None and latest.date() == expected:
+                overall = latest_timestamp(client, dataset_id, column)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.warning("Freshness check for %s failed (%s); fetching without waiting", name, e)
+            return False
+
+        if latest is not None and latest.date() >= expected and overall is not None and overall.date() > expected:
+            logger.info("%s is fresh: latest %s, dataset latest %s, expected %s", name, latest, overall, expected)
+            return True
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning(
+                "%s still ends at %s, not past %s; deadline reached, fetching anyway",
+                name, latest, expected,
+            )
+            return False
+
+        delay = min(next(delays), remaining)
+        logger.info("%s latest is %s, waiting to get past %s; checking again in %.0fs", name, latest, expected, delay)
+        sleep(delay)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Stale-while-revalidate fallback for Datawrapper maps.
+
+Every successful publish stores the uploaded CSV, the intro text and the
+date it covers in ``state/last_good/<chart_id>.json``. If a later run cannot
+refresh the map (Socrata error, open circuit, empty result),
+``serve_stale`` re-publishes that payload straight from disk, with a
+"Data as of ..." note so readers know it is not today's update. That takes
+three Datawrapper calls and no Socrata query.
+
+Maps that fell back are queued. ``revalidate`` runs at the end of
+``update_all_maps`` and retries them once, after waiting at least
+``REVALIDATE_AFTER_SECONDS`` (default 60) from the first fallback to give a
+blip time to clear.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from circuit_breaker import STATE_DIR
+import publish_queue
+import publish_state
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = STATE_DIR / "last_good"
+REVALIDATE_AFTER_SECONDS = float(os.environ.get("REVALIDATE_AFTER_SECONDS", "60"))
+
+_lock = threading.Lock()
+_pending: List[str] = []
+_first_fallback_at: Optional[float] = None
+_revalidating = threading.local()
+
+
+def _path(chart_id: str) -> Path:
+    return STORE_DIR / f"{chart_id}.json"
+
+
+def save(chart_id: str, csv_content: Union[bytes, str], intro: str, as_of: str) -> None:
+    """Remember a payload that was just published successfully."""
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    if isinstance(csv_content, bytes):
+        csv_content = csv_content.decode("utf-8")
+    payload = {
+        "chart_id": chart_id,
+        "csv": csv_content,
+        "intro": intro,
+        "as_of": as_of,
+        "saved_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    tmp = _path(chart_id).with_suffix(".tmp")
+    tmp.write_text(json.dumps(payload))
+    tmp.replace(_path(chart_id))
+
+
+def load(chart_id: str) -> Optional[Dict[str, Any]]:
+    path = _path(chart_id)
+    if not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text())
+    except Exception as e:
+        logger.warning("Could not read last good payload for %s: %s", chart_id, e)
+        return None
+
+
+def republish(chart_id: str) -> bool:
+    """Re-publish the stored payload for ``chart_id``; False if there is none."""
+    payload = load(chart_id)
+    if payload is None:
+        logger.warning("No last good payload stored for %s", chart_id)
+        return False
+
+    # The chart no longer matches its publish fingerprint; the next fresh payload must go out
+    publish_state.forget(chart_id)
+    # A queued payload is fresher than this one, so don't displace it
+    publish_queue.publish(chart_id, payload["csv"], {
+        "describe": {"intro": payload["intro"]},
+        "annotate": {"notes": f"Data as of {payload['as_of']}. Today's update is delayed."},
+    }, replace=False)
+    logger.info("Re-published %s from last good payload (data as of %s)", chart_id, payload["as_of"])
+    return True
+
+
+def serve_stale(config_name: str, chart_id: str) -> None:
+    """Fall back to the last good payload and queue the map for revalidation."""
+    global _first_fallback_at
+    if getattr(_revalidating, "active", False):
+        # Already serving stale data from the first attempt; nothing more to do.
+        return
+    with _lock:
+        if config_name not in _pending:
+            _pending.append(config_name)
+        if _first_fallback_at is None:
+            _first_fallback_at = time.monotonic()
+    try:
+        republish(chart_id)
+    except Exception as e:
+        logger.error("Could not re-publish last good payload for %s: %s", config_name, e)
+
+
+def revalidate(func: Callable[[str], Any]) -> None:
+    """Retry every map that fell back during this run by calling ``func(name)``."""
+    global _first_fallback_at
+    with _lock:
+        names, _pending[:] = list(_pending), []
+        started = _first_fallback_at
+        _first_fallback_at = None
+    if not names:
+        return
+
+    wait = REVALIDATE_AFTER_SECONDS - (time.monotonic() - started)
+    if wait > 0:
+        logger.info("Waiting %.0fs before revalidating %d stale maps", wait, len(names))
+        time.sleep(wait)
+
+    _revalidating.active = True
+    try:
+        for name in names:
+            logger.info("Revalidating %s", name)
+            func(name)
+    finally:
+        _revalidating.active = False
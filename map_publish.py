@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Publish a Datawrapper map in three requests.
+
+A map update used to take about seven calls: ``get_chart``, ``update_chart``,
+the data PUT, ``publish_chart``, a second ``get_chart`` just to read
+``publicUrl``, and then ``apply_map_template``, which fetched the chart again
+and rewrote the metadata that had just been written. That second write landed
+after the publish, so template and tooltip changes only went live on the next
+run.
+
+Now each map script builds one merged metadata document, with template,
+tooltip, intro and notes, from the template snapshot that ``update_all_maps``
+takes once per run. ``publish_map`` then sends it in three requests on the
+pooled Datawrapper session:
+
+1. ``PATCH /charts/<id>`` with the metadata. Datawrapper merges it into the
+   chart's, so the title and anything else we don't send are kept.
+2. ``PUT /charts/<id>/data`` with the CSV.
+3. ``POST /charts/<id>/publish``.
+
+The public URL is built from the chart ID and the version in the publish
+response. It is not fetched.
+
+The CSV upload is gzip-compressed as it is sent: ``_gzip_chunks`` compresses
+the payload ``UPLOAD_CHUNK_SIZE`` bytes at a time and requests streams the
+chunks with ``Transfer-Encoding: chunked``, so the compressed body is never
+held in memory as a whole. CSVs are mostly repeated digits and category names
+and shrink several times over. The first gzip upload in a process reads the
+data back and compares it with the CSV, since an API that ignores
+``Content-Encoding`` would store the compressed bytes as the chart's data.
+If Datawrapper rejects the upload or stores it wrong, that CSV and every later
+one in the process go up uncompressed. ``DATAWRAPPER_GZIP_UPLOADS=0`` turns
+compression off. Each upload logs its raw and compressed size.
+
+Charts publish the same way, through ``publish_queue.publish``, which calls
+``publish_map`` directly or from the queue worker.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import zlib
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+import requests
+
+from circuit_breaker import DATAWRAPPER_HOST, get_breaker
+from clients import DATAWRAPPER_API_KEY, datawrapper_rate_limiter, get_session
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.datawrapper.de/v3/charts"
+PUBLIC_URL = "https://datawrapper.dwcdn.net"
+
+GZIP_UPLOADS = os.environ.get("DATAWRAPPER_GZIP_UPLOADS", "1").strip().lower() not in ("0", "false", "no")
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Statuses that mean Datawrapper won't take a gzip or chunked body
+GZIP_REJECTED = (400, 411, 415)
+
+# None until the first gzip upload in the process has been read back
+_gzip_ok: Optional[bool] = None if GZIP_UPLOADS else False
+_gzip_lock = threading.Lock()
+
+
+def public_url(chart_id: str, version: Optional[int] = None) -> str:
+    """Public URL of a published chart (the latest version if ``version`` is None)."""
+    return f"{PUBLIC_URL}/{chart_id}/{version}/" if version else f"{PUBLIC_URL}/{chart_id}/"
+
+
+def load_template(template: Union[None, str, Mapping[str, Any]]) -> Optional[Dict[str, Any]]:
+    """A template snapshot from ``save_map_template``, given as the dict or its JSON file."""
+    if template is None or isinstance(template, Mapping):
+        return template
+    with open(template, "r") as f:
+        return json.load(f)
+
+
+def _request(method: str, url: str, expected: int, accept: Tuple[int, ...] = (), **kwargs: Any) -> requests.Response:
+    """Send through the breaker; any status but ``expected`` or one in ``accept`` raises ``HTTPError``."""
+    headers = {"Authorization": f"Bearer {DATAWRAPPER_API_KEY}", **kwargs.pop("headers", {})}
+
+    def send() -> requests.Response:
+        datawrapper_rate_limiter().acquire()
+        response = get_session(DATAWRAPPER_HOST).request(method, url, headers=headers, **kwargs)
+        if response.status_code != expected and response.status_code not in accept:
+            logger.error("%s %s failed: %s %s", method, url, response.status_code, response.text)
+            raise requests.HTTPError(f"{method} {url} failed: {response.status_code}", response=response)
+        return response
+
+    return get_breaker(DATAWRAPPER_HOST).call(send)
+
+
+def _gzip_chunks(payload: bytes, sizes: List[int]) -> Iterator[bytes]:
+    """Gzip ``payload`` a chunk at a time, appending each compressed chunk's size to ``sizes``."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    view = memoryview(payload)
+    for start in range(0, len(view), UPLOAD_CHUNK_SIZE):
+        chunk = compressor.compress(view[start:start + UPLOAD_CHUNK_SIZE])
+        if chunk:
+            sizes.append(len(chunk))
+            yield chunk
+    chunk = compressor.flush()
+    sizes.append(len(chunk))
+    yield chunk
+
+
+def _normalized(csv_content: bytes) -> bytes:
+    return csv_content.replace(b"\r\n", b"\n").strip()
+
+
+def _put_gzip(chart_id: str, payload: bytes, verify: bool) -> bool:
+    """Upload ``payload`` gzipped; False if Datawrapper rejected it or (with ``verify``) stored it wrong."""
+    global _gzip_ok
+    url = f"{API_URL}/{chart_id}/data"
+    sizes: List[int] = []
+    response = _request("PUT", url, 204, accept=GZIP_REJECTED, data=_gzip_chunks(payload, sizes), headers={
+        "Content-Type": "text/csv; charset=utf-8",
+        "Content-Encoding": "gzip",
+    })
+    if response.status_code in GZIP_REJECTED:
+        logger.warning("Datawrapper rejected the gzip upload for %s (%s %s); sending CSVs uncompressed",
+                       chart_id, response.status_code, response.text)
+        _gzip_ok = False
+        return False
+    if verify and _normalized(_request("GET", url, 200).content) != _normalized(payload):
+        logger.warning("Datawrapper didn't decode the gzip upload for %s; sending CSVs uncompressed", chart_id)
+        return False
+    logger.info("Uploaded %s: %d bytes of CSV as %d bytes gzipped", chart_id, len(payload), sum(sizes))
+    return True
+
+
+def _upload(chart_id: str, payload: bytes) -> None:
+    global _gzip_ok
+    if _gzip_ok is None:
+        # Other threads wait here until the first upload shows whether gzip works
+        with _gzip_lock:
+            if _gzip_ok is None:
+                _gzip_ok = _put_gzip(chart_id, payload, verify=True)
+                if _gzip_ok:
+                    return
+    if _gzip_ok and _put_gzip(chart_id, payload, verify=False):
+        return
+    _request("PUT", f"{API_URL}/{chart_id}/data", 204, data=payload,
+             headers={"Content-Type": "text/csv; charset=utf-8"})
+    logger.info("Uploaded %s: %d bytes of CSV uncompressed", chart_id, len(payload))
+
+
+def publish_map(chart_id: str, metadata: Mapping[str, Any], csv_content: Union[bytes, str]) -> str:
+    """Write ``metadata`` and ``csv_content`` to the map, publish it and return its public URL."""
+    if isinstance(csv_content, str):
+        csv_content = csv_content.encode("utf-8")
+    _request("PATCH", f"{API_URL}/{chart_id}", 200, json={"metadata": metadata})
+    _upload(chart_id, csv_content)
+    published = _request("POST", f"{API_URL}/{chart_id}/publish", 200)
+    try:
+        version = published.json().get("version")
+    except ValueError:
+        version = None
+    return public_url(chart_id, version)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Month-by-year chart tables built from a NumPy matrix.
+
+The year-over-year line charts all take the same table: one row per month
+(Jan..Dec), one column per year, in ascending order. ``pivot_month_year``
+builds it without pandas pivot machinery. The (year, month, value) triples are
+scattered into a preallocated 12 x Y matrix, and the frame is built from that
+matrix in one go.
+
+Like ``DataFrame.pivot``, it raises ``ValueError`` when a (year, month) pair
+appears twice, rather than keeping one of the values.
+
+Counts that arrive as integers (Socrata returns them as digit strings) come
+back as nullable ``Int64`` columns, so the CSV keeps "123" rather than
+"123.0", as the old string pivot did. ``integer=False`` keeps float columns
+instead; the RDC charts always pivoted numeric columns and published
+"2560.0". Months without data are empty cells.
+
+With ``TRANSFORM_BACKEND=polars`` the matrix comes from a Polars pivot (see
+``transform_backend.py``); the chart table is built the same way after that.
+"""
+from __future__ import annotations
+
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import transform_backend
+
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def _numeric(values: pd.Series) -> pd.Series:
+    return pd.to_numeric(values, errors="coerce")
+
+
+def _year_month(df: pd.DataFrame, year_column: Optional[str], month_column: Optional[str],
+                date_column: Optional[str]) -> tuple:
+    if date_column is not None:
+        dates = pd.to_datetime(df[date_column])
+        return dates.dt.year.to_numpy(), dates.dt.month.to_numpy()
+    return _numeric(df[year_column]).astype(int).to_numpy(), _numeric(df[month_column]).astype(int).to_numpy()
+
+
+def _matrix(years: np.ndarray, months: np.ndarray, values: pd.Series) -> tuple:
+    # 12 x Y matrix of values plus the sorted years along its columns
+    values = values.to_numpy(dtype=float, na_value=np.nan)
+    unique_years, year_index = np.unique(years, return_inverse=True)
+    cells = (months - 1) * len(unique_years) + year_index
+    if len(np.unique(cells)) != len(cells):
+        _, first, counts = np.unique(cells, return_index=True, return_counts=True)
+        repeated = sorted({(int(years[i]), int(months[i])) for i in first[counts > 1]})
+        raise ValueError(f"Duplicate month/year rows, cannot pivot: {repeated}")
+    if transform_backend.use_polars():
+        return transform_backend.month_year_matrix(years, months, values)
+    matrix = np.full((12, len(unique_years)), np.nan)
+    matrix[months - 1, year_index] = values
+    return matrix, unique_years
+
+
+def _chart_frame(matrix: np.ndarray, years: Sequence[int], integer: bool) -> pd.DataFrame:
+    frame = pd.DataFrame(matrix, columns=[str(year) for year in years])
+    if integer:
+        frame = frame.astype("Int64")
+    frame.insert(0, "month", MONTH_NAMES)
+    return frame
+
+
+def pivot_month_year(df: pd.DataFrame, value_column: str = "count", year_column: Optional[str] = "year",
+                     month_column: Optional[str] = "month", date_column: Optional[str] = None,
+                     integer: Optional[bool] = None) -> pd.DataFrame:
+    """Return a ``month`` column plus one column per year from long-form rows.
+
+    Rows are located by ``year_column``/``month_column`` (month numbers 1-12) or,
+    if ``date_column`` is given, by that column's year and month. ``integer``
+    says whether the year columns are ``Int64``; None decides from the values.
+    """
+    years, months = _year_month(df, year_column, month_column, date_column)
+    values = _numeric(df[value_column])
+    matrix, unique_years = _matrix(years, months, values)
+    if integer is None:
+        integer = pd.api.types.is_integer_dtype(values)
+    return _chart_frame(matrix, unique_years, integer)
+
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""Durable Datawrapper publish queue, drained by a single worker.
+
+Each of the twelve scripts used to talk to Datawrapper on its own. Nothing
+saw the overall request rate, retries were ad hoc, and a publish that failed
+was lost. Getting the chart right meant refetching its data on the next run.
+
+With ``PUBLISH_QUEUE=1``, which ``run_all_updates.py`` sets for its
+scripts, ``publish`` no longer calls Datawrapper. It writes the CSV to
+``state/publish_queue/`` and records a job in ``state/publish_queue.sqlite3``
+with the chart ID, payload path, metadata and publish fingerprint. One worker
+(``drain``) publishes the jobs in the order they were queued. It runs in the
+``run_all_updates.py`` process while the scripts run, or standalone with
+``python publish_queue.py``.
+
+- Coalescing: the queue holds one job per chart. Queueing a chart that is
+  still waiting replaces its payload and keeps its place in line. Queueing
+  the same fingerprint again is a no-op.
+- Rate limit: only the worker publishes, through ``map_publish.publish_map``
+  and so through the shared Datawrapper rate limiter and circuit breaker.
+- Retry: outages (connection errors, 5xx, 429, an open circuit) are retried
+  with exponential backoff from ``PUBLISH_QUEUE_RETRY_SECONDS`` (default 30),
+  up to ``PUBLISH_QUEUE_MAX_ATTEMPTS`` (default 5). Other errors, and outages
+  that use up their attempts, mark the job ``failed`` until the chart is
+  queued again. Jobs still waiting when the run ends stay queued for the next
+  one, so a failed publish never needs a refetch.
+- Crash safety: the worker holds a lease in the database and renews it while
+  it works. If a worker dies, its lease expires after
+  ``PUBLISH_QUEUE_LEASE_SECONDS`` (default 600). The next worker takes over
+  and puts any job left ``running`` back in line.
+- Reporting: each job records the script that queued it
+  (``PUBLISH_QUEUE_SOURCE``, set by ``run_all_updates.py``). ``unpublished``
+  lists the jobs still in the queue after a drain, so the runner can fail the
+  scripts whose publishes didn't go out.
+
+A successful job does what an inline publish does: it records the
+fingerprint in ``publish_state``, and for maps it saves the payload to
+``last_good``.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Any, Dict, List, Mapping, Optional, Union
+
+import pandas as pd
+
+from circuit_breaker import STATE_DIR, CircuitOpenError, is_outage
+import last_good
+from map_publish import publish_map
+import publish_state
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = STATE_DIR / "publish_queue.sqlite3"
+PAYLOAD_DIR = STATE_DIR / "publish_queue"
+
+MAX_ATTEMPTS = int(os.environ.get("PUBLISH_QUEUE_MAX_ATTEMPTS", "5"))
+RETRY_SECONDS = float(os.environ.get("PUBLISH_QUEUE_RETRY_SECONDS", "30"))
+LEASE_SECONDS = float(os.environ.get("PUBLISH_QUEUE_LEASE_SECONDS", "600"))
+# How long a final drain waits for jobs that are backing off before leaving them for the next run
+DRAIN_WAIT_SECONDS = float(os.environ.get("PUBLISH_QUEUE_DRAIN_WAIT_SECONDS", "300"))
+POLL_SECONDS = 2.0
+# Script that queued the jobs this process adds; run_all_updates.py sets it per script
+SOURCE = os.environ.get("PUBLISH_QUEUE_SOURCE")
+
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    chart_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    payload_path TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    fingerprint TEXT,
+    intro TEXT,
+    as_of TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    queued_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS worker (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT NOT NULL,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+def enabled() -> bool:
+    """Whether ``publish`` queues instead of publishing inline."""
+    return os.environ.get("PUBLISH_QUEUE", "").strip().lower() in ("1", "true", "yes")
+
+
+def _connect() -> sqlite3.Connection:
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    # Autocommit; writers take the lock up front with BEGIN IMMEDIATE
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    if "source" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+        try:
+            conn.execute("ALTER TABLE jobs ADD COLUMN source TEXT")
+        except sqlite3.OperationalError:
+            pass  # another process added it first
+    return conn
+
+
+def _write_payload(chart_id: str, payload: bytes) -> str:
+    PAYLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    path = PAYLOAD_DIR / f"{chart_id}-{hashlib.sha256(payload).hexdigest()[:16]}.csv"
+    if not path.exists():
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(payload)
+        tmp.replace(path)
+    return str(path)
+
+
+def _remove_payload(path: Optional[str]) -> None:
+    if path:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def enqueue(chart_id: str, data: Union[pd.DataFrame, bytes, str], metadata: Mapping[str, Any],
+            fingerprint: Optional[publish_state.Fingerprint] = None, intro: Optional[str] = None,
+            as_of: Optional[str] = None, replace: bool = True) -> bool:
+    """Queue a publish of ``data`` and ``metadata`` to ``chart_id``; False if coalesced away.
+
+    ``fingerprint`` is recorded in ``publish_state`` once the job succeeds (None forgets
+    the chart's record instead). ``intro`` and ``as_of`` are saved to ``last_good``.
+    With ``replace=False`` the job is dropped if the chart already has one queued.
+    """
+    path = _write_payload(chart_id, publish_state.csv_payload(data))
+    fingerprint_json = json.dumps(fingerprint, sort_keys=True) if fingerprint else None
+    now = time.time()
+    with closing(_connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT * FROM jobs WHERE chart_id = ?", (chart_id,)).fetchone()
+        if row is not None and (not replace or (
+                row["status"] != FAILED and fingerprint_json and row["fingerprint"] == fingerprint_json)):
+            conn.execute("COMMIT")
+            if path != row["payload_path"]:
+                _remove_payload(path)
+            logger.info("Publish of %s already queued, not queueing another", chart_id)
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (chart_id, version, payload_path, metadata, fingerprint, intro, as_of, "
+            "status, attempts, queued_at, next_attempt_at, last_error, source) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, NULL, ?)",
+            (chart_id, (row["version"] + 1) if row else 1, path, json.dumps(metadata), fingerprint_json, intro,
+             as_of, PENDING, row["queued_at"] if row and row["status"] != FAILED else now, now, SOURCE),
+        )
+        conn.execute("COMMIT")
+    if row is not None and row["payload_path"] != path:
+        _remove_payload(row["payload_path"])
+    logger.info("Queued publish of %s%s", chart_id, " (replacing the queued payload)" if row else "")
+    return True
+
+
+def _publish_job(chart_id: str, csv_content: bytes, metadata: Mapping[str, Any],
+                 fingerprint: Optional[publish_state.Fingerprint], intro: Optional[str], as_of: Optional[str]) -> str:
+    published_url = publish_map(chart_id, metadata, csv_content)
+    if fingerprint:
+        publish_state.record(chart_id, fingerprint, published_url)
+    else:
+        publish_state.forget(chart_id)
+    if intro is not None:
+        last_good.save(chart_id, csv_content, intro, as_of)
+    return published_url
+
+
+def publish(chart_id: str, data: Union[pd.DataFrame, bytes, str], metadata: Mapping[str, Any],
+            fingerprint: Optional[publish_state.Fingerprint] = None, intro: Optional[str] = None,
+            as_of: Optional[str] = None, replace: bool = True) -> str:
+    """Publish now, or queue the publish when the queue is enabled (see ``enqueue``).
+
+    Returns the chart's public URL (the last known one when queued).
+    """
+    if enabled():
+        enqueue(chart_id, data, metadata, fingerprint, intro, as_of, replace)
+        return publish_state.public_url(chart_id)
+    return _publish_job(chart_id, publish_state.csv_payload(data), metadata, fingerprint, intro, as_of)
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _acquire_lease(conn: sqlite3.Connection, owner: str) -> bool:
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    lease = conn.execute("SELECT owner, heartbeat FROM worker WHERE id = 1").fetchone()
+    if lease is not None and lease["owner"] != owner and now - lease["heartbeat"] < LEASE_SECONDS:
+        conn.execute("COMMIT")
+        return False
+    conn.execute("INSERT OR REPLACE INTO worker VALUES (1, ?, ?)", (owner, now))
+    # Whatever the last worker was publishing when it died goes back in line
+    resumed = conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (PENDING, RUNNING)).rowcount
+    conn.execute("COMMIT")
+    if resumed:
+        logger.warning("Resuming %d publish jobs interrupted by a previous worker", resumed)
+    return True
+
+
+def _heartbeat(conn: sqlite3.Connection, owner: str) -> None:
+    conn.execute("UPDATE worker SET heartbeat = ? WHERE id = 1 AND owner = ?", (time.time(), owner))
+
+
+def _release_lease(conn: sqlite3.Connection, owner: str) -> None:
+    conn.execute("DELETE FROM worker WHERE id = 1 AND owner = ?", (owner,))
+
+
+def _claim(conn: sqlite3.Connection, owner: str) -> Optional[Dict[str, Any]]:
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute(
+        "SELECT * FROM jobs WHERE status = ? AND next_attempt_at <= ? ORDER BY queued_at LIMIT 1",
+        (PENDING, time.time()),
+    ).fetchone()
+    if row is None:
+        conn.execute("COMMIT")
+        return None
+    job = dict(row)
+    try:
+        # Read under the lock: a concurrent enqueue may replace and delete this payload right after
+        with open(job["payload_path"], "rb") as f:
+            job["csv"] = f.read()
+    except OSError as e:
+        conn.execute("UPDATE jobs SET status = ?, last_error = ? WHERE chart_id = ?",
+                     (FAILED, f"payload unreadable: {e}", job["chart_id"]))
+        conn.execute("COMMIT")
+        logger.error("Publish of %s failed, payload unreadable: %s", job["chart_id"], e)
+        return None
+    conn.execute("UPDATE jobs SET status = ? WHERE chart_id = ?", (RUNNING, job["chart_id"]))
+    _heartbeat(conn, owner)
+    conn.execute("COMMIT")
+    return job
+
+
+def _finish(conn: sqlite3.Connection, job: Dict[str, Any]) -> bool:
+    """Run a claimed job and settle its row; True if it published."""
+    chart_id = job["chart_id"]
+    try:
+        published_url = _publish_job(
+            chart_id, job["csv"], json.loads(job["metadata"]),
+            json.loads(job["fingerprint"]) if job["fingerprint"] else None, job["intro"], job["as_of"],
+        )
+    except Exception as e:
+        attempts = job["attempts"] + 1
+        retry = (isinstance(e, CircuitOpenError) or is_outage(e)) and attempts < MAX_ATTEMPTS
+        delay = e.retry_in if isinstance(e, CircuitOpenError) else RETRY_SECONDS * 2 ** (attempts - 1)
+        # Only touch the row if it still holds this job; a newer payload may have replaced it
+        conn.execute(
+            "UPDATE jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? "
+            "WHERE chart_id = ? AND version = ?",
+            (PENDING if retry else FAILED, attempts, time.time() + delay, str(e), chart_id, job["version"]),
+        )
+        if retry:
+            logger.warning("Publish of %s failed (attempt %d of %d), retrying in %.0fs: %s",
+                           chart_id, attempts, MAX_ATTEMPTS, delay, e)
+        else:
+            logger.error("Publish of %s failed after %d attempts: %s", chart_id, attempts, e)
+        return False
+
+    done = conn.execute("DELETE FROM jobs WHERE chart_id = ? AND version = ?", (chart_id, job["version"])).rowcount
+    if done:
+        _remove_payload(job["payload_path"])
+    logger.info("Published %s from the queue: %s", chart_id, published_url)
+    return True
+
+
+def drain(stop: Optional[threading.Event] = None, wait_seconds: float = DRAIN_WAIT_SECONDS) -> int:
+    """Publish queued jobs until the queue is empty; return how many were published.
+
+    With ``stop``, keep polling for new jobs until it is set. Either way, jobs that
+    are backing off are waited for up to ``wait_seconds``, then left for the next run.
+    """
+    owner = _owner()
+    published = 0
+    with closing(_connect()) as conn:
+        if not _acquire_lease(conn, owner):
+            logger.info("Another worker is draining the publish queue")
+            return 0
+        try:
+            deadline = None
+            while True:
+                job = _claim(conn, owner)
+                if job is not None:
+                    published += _finish(conn, job)
+                    continue
+                next_due = conn.execute(
+                    "SELECT MIN(next_attempt_at) FROM jobs WHERE status = ?", (PENDING,)
+                ).fetchone()[0]
+                now = time.time()
+                if stop is None or stop.is_set():
+                    if next_due is None:
+                        break
+                    deadline = deadline or now + wait_seconds
+                    if next_due > deadline:
+                        break
+                pause = POLL_SECONDS if next_due is None else min(POLL_SECONDS, max(0.0, next_due - now))
+                if stop is not None and not stop.is_set():
+                    stop.wait(pause)
+                else:
+                    time.sleep(pause)
+                _heartbeat(conn, owner)
+        finally:
+            _release_lease(conn, owner)
+            waiting = summary(conn)
+    if waiting.get(PENDING) or waiting.get(FAILED):
+        logger.warning("Publish queue: %d jobs left for the next run, %d failed",
+                       waiting.get(PENDING, 0), waiting.get(FAILED, 0))
+    return published
+
+
+def summary(conn: Optional[sqlite3.Connection] = None) -> Dict[str, int]:
+    """Number of queued jobs by status."""
+    if conn is None:
+        if not DB_PATH.exists():
+            return {}
+        with closing(_connect()) as own:
+            return summary(own)
+    return {row["status"]: row["count"]
+            for row in conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")}
+
+
+
+def unpublished(conn: Optional[sqlite3.Connection] = None) -> List[Dict[str, Any]]:
+    """Jobs still queued (waiting to retry or failed), oldest first, without their payloads."""
+    if conn is None:
+        if not DB_PATH.exists():
+            return []
+        with closing(_connect()) as own:
+            return unpublished(own)
+    return [dict(row) for row in conn.execute(
+        "SELECT chart_id, source, status, attempts, last_error FROM jobs ORDER BY queued_at"
+    )]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.info("Published %d queued jobs", drain())
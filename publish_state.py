@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Skip Datawrapper uploads and publishes when nothing material changed.
+
+Monthly charts change once a month and the RDC charts less often than that,
+yet every run used to re-upload, re-write and re-publish all of them. After
+a successful publish, ``record`` stores a fingerprint of what was sent in
+``state/published/<chart_id>.json``, along with the public URL. The
+fingerprint is the SHA-256 of the uploaded CSV and of the metadata. The next
+run builds the same fingerprint before touching Datawrapper, and if
+``unchanged`` says it matches, the chart is left alone.
+
+The "Data updated on <date>" note is left out of the metadata hash. It
+changes every day without saying anything about the data, so a chart keeps
+the note from the last run that actually changed it.
+
+``FORCE_PUBLISH=1`` ignores the stored fingerprints for a run.
+``forget`` drops a chart's record. ``last_good`` calls it after a stale
+republish, so the next fresh payload is always published.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional, Union
+
+import pandas as pd
+
+from circuit_breaker import STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = STATE_DIR / "published"
+FORCE_PUBLISH = os.environ.get("FORCE_PUBLISH", "").strip().lower() in ("1", "true", "yes")
+
+_UPDATED_NOTE = re.compile(r"^Data updated on ")
+
+Fingerprint = Dict[str, str]
+
+
+def _path(chart_id: str) -> Path:
+    return STORE_DIR / f"{chart_id}.json"
+
+
+def _digest(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def csv_payload(data: Union[pd.DataFrame, bytes, str]) -> bytes:
+    """The bytes uploaded for ``data``."""
+    if isinstance(data, pd.DataFrame):
+        # Same serialization the datawrapper client uses for add_data
+        data = data.to_csv(index=False, encoding="utf-8")
+    return data if isinstance(data, bytes) else data.encode("utf-8")
+
+
+def _material_metadata(metadata: Mapping[str, Any]) -> Dict[str, Any]:
+    material = dict(metadata)
+    annotate = material.get("annotate")
+    if isinstance(annotate, Mapping) and _UPDATED_NOTE.match(str(annotate.get("notes", ""))):
+        material["annotate"] = {key: value for key, value in annotate.items() if key != "notes"}
+    return material
+
+
+def fingerprint(data: Union[pd.DataFrame, bytes, str], metadata: Mapping[str, Any]) -> Fingerprint:
+    """Hashes of the CSV that will be uploaded and of its metadata, minus the updated-on note."""
+    metadata_json = json.dumps(_material_metadata(metadata), sort_keys=True, default=str)
+    return {"data": _digest(csv_payload(data)), "metadata": _digest(metadata_json.encode("utf-8"))}
+
+
+def _load(chart_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(_path(chart_id).read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable publish state for %s: %s", chart_id, e)
+        return None
+
+
+def unchanged(chart_id: str, current: Fingerprint) -> bool:
+    """Whether ``current`` matches the last successful publish of ``chart_id``."""
+    if FORCE_PUBLISH:
+        return False
+    record = _load(chart_id)
+    return bool(record) and record.get("fingerprint") == current
+
+
+def public_url(chart_id: str) -> str:
+    """Public URL stored with the last publish."""
+    record = _load(chart_id) or {}
+    return record.get("public_url") or "Unknown URL"
+
+
+def record(chart_id: str, current: Fingerprint, url: Optional[str] = None) -> None:
+    """Remember a successful publish."""
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    payload = {
+        "chart_id": chart_id,
+        "fingerprint": current,
+        "public_url": url,
+        "published_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    tmp = _path(chart_id).with_suffix(".tmp")
+    tmp.write_text(json.dumps(payload))
+    tmp.replace(_path(chart_id))
+
+
+def forget(chart_id: str) -> None:
+    """Drop the stored fingerprint so the next payload is published regardless."""
+    _path(chart_id).unlink(missing_ok=True)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Publish several Datawrapper charts at once.
+
+Once a chart's data is ready, most of the time spent publishing it is
+Datawrapper rendering it, and that has nothing to do with the other charts.
+The scripts used to fetch a config, then wait for its upload and publish to
+finish, and only then start on the next config. A ``Publisher`` takes the
+Datawrapper half instead. ``submit(chart_id, func, ...)`` queues ``func``
+(the metadata/data/publish sequence) on a pool of ``PUBLISH_WORKERS``
+threads (default 4) and returns at once. The caller moves on to fetching the
+next config while earlier charts upload and render.
+
+- Jobs for the same chart run one after another, in the order they were
+  submitted. Different charts run in parallel.
+- Every Datawrapper call, from any thread, still goes through the host's
+  circuit breaker and the shared ``datawrapper_rate_limiter`` in
+  ``clients.py``. More workers never means more than
+  ``DATAWRAPPER_REQUESTS_PER_SECOND``.
+- A failing job doesn't stop the others. ``wait`` blocks until every job is
+  done, logs one summary of the failed charts and returns them by chart ID.
+  Scripts that should exit non-zero raise ``PublishError`` with them.
+
+``PUBLISH_WORKERS=1`` runs each job inline in ``submit``, exactly as before.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_for
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_WORKERS = max(1, int(os.environ.get("PUBLISH_WORKERS", "4")))
+
+
+class PublishError(Exception):
+    """One or more charts failed to publish; ``failures`` maps chart ID to its error."""
+
+    def __init__(self, failures: Dict[str, BaseException]):
+        self.failures = failures
+        super().__init__(_describe(failures))
+
+
+def _describe(failures: Dict[str, BaseException]) -> str:
+    return "; ".join(f"{chart_id}: {error}" for chart_id, error in failures.items())
+
+
+def _after(previous: Optional[Future], func: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+    if previous is not None:
+        # Submitted earlier, so already running or done; only waits out the chart's last job
+        wait_for([previous])
+    return func(*args, **kwargs)
+
+
+class Publisher:
+    """Bounded pool of publish jobs, ordered per chart. Use as a context manager."""
+
+    def __init__(self, workers: int = PUBLISH_WORKERS):
+        self.workers = max(1, workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="publish") if self.workers > 1 else None
+        self._last: Dict[str, Future] = {}
+        self._jobs: List[Tuple[str, Future]] = []
+        self._lock = threading.Lock()  # configs on different portals submit from their own threads
+        self.failures: Dict[str, BaseException] = {}
+
+    def submit(self, chart_id: str, func: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        """Run ``func(*args, **kwargs)`` after any earlier job for ``chart_id``."""
+        if self._pool is None:
+            future: Future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            with self._lock:
+                self._jobs.append((chart_id, future))
+            return future
+        with self._lock:
+            future = self._pool.submit(_after, self._last.get(chart_id), func, args, kwargs)
+            self._last[chart_id] = future
+            self._jobs.append((chart_id, future))
+        return future
+
+    def wait(self) -> Dict[str, BaseException]:
+        """Block until every job is done; return (and keep in ``failures``) each failed chart's last error."""
+        failures = self.failures = {}
+        for chart_id, future in self._jobs:
+            error = future.exception()
+            if error is not None:
+                failures[chart_id] = error
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        charts = len({chart_id for chart_id, _ in self._jobs})
+        if failures:
+            logger.error("%d of %d charts failed to publish: %s", len(failures), charts, _describe(failures))
+        elif charts:
+            logger.info("Publish jobs finished for %d charts (%d workers)", charts, self.workers)
+        return failures
+
+    def __enter__(self) -> "Publisher":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.wait()
@@ -3,11 +3,16 @@
 Master script to run all SF Examiner chart and map updates
 """
 
+import os
 import subprocess
 import sys
 import logging
+import threading
 from datetime import datetime
 
+import circuit_breaker
+import publish_queue
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -22,8 +27,10 @@ def run_script(script_name, description):
     """Run a Python script and log results"""
     try:
         logging.info(f"Starting {description}...")
+        # Queued publishes are tagged with the script, so queue failures count against it
         result = subprocess.run([sys.executable, script_name], 
-                              capture_output=True, text=True, timeout=600)
+                              capture_output=True, text=True, timeout=600,
+                              env={**os.environ, "PUBLISH_QUEUE_SOURCE": script_name})
         
         if result.returncode == 0:
             logging.info(f"✅ {description} completed successfully")
@@ -43,6 +50,7 @@ def run_script(script_name, description):
 def main():
     start_time = datetime.now()
     logging.info("🚀 Starting SF Examiner data update pipeline")
+    circuit_breaker.reset_run_counters()
     
     scripts = [
         ("rdc_inventory_pipeline.py", "RDC Metro Inventory Data Download"),
@@ -59,11 +67,34 @@ def main():
         ("sf_business_openings_pipeline.py", "Business Openings Charts Update")
     ]
     
+    # The scripts queue their Datawrapper publishes; one worker here publishes them while the
+    # scripts run, and the queue keeps anything it can't publish for the next run
+    os.environ.setdefault("PUBLISH_QUEUE", "1")
+    queue_stop = threading.Event()
+    queue_worker = None
+    if publish_queue.enabled():
+        queue_worker = threading.Thread(target=publish_queue.drain, kwargs={"stop": queue_stop}, name="publish-queue")
+        queue_worker.start()
+    
     results = {}
     
-    for script, description in scripts:
-        success = run_script(script, description)
-        results[description] = success
+    try:
+        for script, description in scripts:
+            success = run_script(script, description)
+            results[description] = success
+    finally:
+        queue_stop.set()
+        if queue_worker is not None:
+            queue_worker.join()
+    
+    # A script succeeds once its publishes are queued; any that didn't go out fail it after all
+    descriptions = dict(scripts)
+    unpublished = publish_queue.unpublished() if publish_queue.enabled() else []
+    for job in unpublished:
+        description = descriptions.get(job["source"], "Publish queue")
+        results[description] = False
+        logging.error(f"❌ {job['chart_id']} ({description}) not published: {job['status']} "
+                      f"after {job['attempts']} attempts: {job['last_error']}")
     
     # Summary
     end_time = datetime.now()
@@ -80,6 +111,20 @@ def main():
         status = "✅ SUCCESS" if success else "❌ FAILED"
         logging.info(f"{description}: {status}")
     
+    logging.info("\n🔌 UPSTREAM CIRCUIT BREAKERS")
+    for breaker in circuit_breaker.summary():
+        status = "✅ CLOSED" if breaker["state"] == circuit_breaker.CLOSED else f"⚠️  {breaker['state'].upper()}"
+        logging.info(
+            f"{breaker['host']}: {status} (tripped {breaker['trips']}x this run, "
+            f"{breaker['fast_failures']} calls failed fast)"
+        )
+    
+    queued = publish_queue.summary()
+    if queued:
+        logging.info("\n📬 PUBLISH QUEUE")
+        logging.info(f"{queued.get(publish_queue.PENDING, 0)} publishes left for the next run, "
+                     f"{queued.get(publish_queue.FAILED, 0)} failed")
+    
     logging.info(f"\nCompleted {successful}/{total} updates successfully")
     logging.info(f"Total duration: {duration}")
     
@@ -2,16 +2,31 @@
 # DataSF to Datawrapper Automation Pipeline - 311 Service Request Maps
 # For San Francisco Examiner
 
-import os
 import pandas as pd
-from sodapy import Socrata
-import datawrapper
 import logging
 from datetime import datetime, timedelta
-import requests
+import copy
 import json
 import re
 
+from addresses import normalize_street_address
+from ap_style import ap_datetime_column, format_date_ap_style
+from circuit_breaker import CircuitOpenError, log_summary
+from clients import fetch_lock, get_datawrapper, socrata_for
+from column_spec import NOT_AVAILABLE, ColumnSpec, build_frame, column_or_default, csv_bytes, datawrapper_frame, empty_frame
+from dtype_plan import CATEGORY, COORDINATE, COUNT, DURATION, TEXT
+import last_good
+from map_publish import load_template
+import publish_queue
+import publish_state
+from publisher import Publisher
+from freshness import day_to_map, expected_day, wait_for_fresh
+from spatial_aggregation import (build_grid_query, grid_specs, incident_total, size_by_count,
+                                 to_cell_centers, tooltip_template_for)
+from transform_pool import run_configs, run_transform, start_pool
+from unique_transform import humanize_label, per_unique, title_case
+from validation import coordinate_checks, map_bounds, quarantine_invalid, range_check, timestamp_check
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,78 +39,41 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style (date only).
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
-
-
-def format_datetime_ap_style(dt):
-    """
-    Format a datetime object in AP Style (date and time).
-    - AP Style time: lowercase a.m./p.m., no leading zeros, noon/midnight for 12:00
-    - Format: "Jan. 2, 2025, 1:38 p.m." or "March 15, 2025, noon"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    
-    # Date part
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    
-    # Time part - AP Style
-    hour = dt.hour
-    minute = dt.minute
-    
-    if hour == 0 and minute == 0:
-        time_str = "midnight"
-    elif hour == 12 and minute == 0:
-        time_str = "noon"
-    else:
-        if hour == 0:
-            hour_12 = 12
-            ampm = "a.m."
-        elif hour < 12:
-            hour_12 = hour
-            ampm = "a.m."
-        elif hour == 12:
-            hour_12 = 12
-            ampm = "p.m."
-        else:
-            hour_12 = hour - 12
-            ampm = "p.m."
-        
-        if minute == 0:
-            time_str = f"{hour_12} {ampm}"
-        else:
-            time_str = f"{hour_12}:{minute:02d} {ampm}"
-    
-    return f"{month} {day}, {year}, {time_str}"
+def encampment_details(df):
+    """service_details, with a default for encampment reports that have none"""
+    details = column_or_default(df, 'service_details').fillna('')
+    service_name = column_or_default(df, 'service_name').fillna('N/A')
+    is_encampment = service_name.isin(['Encampment', 'Encampments'])
+    return details.mask(is_encampment & details.isin(['', NOT_AVAILABLE]), 'Encampment reported')
 
-# API Credentials
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DATASF_APP_TOKEN = os.environ.get("DATASF_APP_TOKEN", "xdboBmIBQtjISZqIRYDWjKyxY")
 
-# Initialize API clients
-dw = datawrapper.Datawrapper(access_token=DATAWRAPPER_API_KEY)
-client = Socrata("data.sfgov.org", DATASF_APP_TOKEN)
+# Output columns of the map frame and the Datawrapper CSV (see column_spec.py)
+# service_details/service_subtype: underscores become spaces, then sentence case
+MAP_COLUMNS = [
+    ColumnSpec('lat', dtype=COORDINATE, csv_name='latitude'),
+    ColumnSpec('long', dtype=COORDINATE, csv_name='longitude'),
+    ColumnSpec('status', source='status_description', dtype=CATEGORY),
+    ColumnSpec('address', clean=normalize_street_address, dtype=TEXT),
+    ColumnSpec('reported_datetime', dtype=TEXT),
+    ColumnSpec('hours_ago', dtype=DURATION),
+    ColumnSpec('neighborhood', source='neighborhoods_sffind_boundaries', missing=NOT_AVAILABLE, fill='N/A',
+               clean=per_unique(title_case), dtype=CATEGORY),
+    ColumnSpec('district', source='supervisor_district', missing=NOT_AVAILABLE, fill='N/A', dtype=CATEGORY),
+    ColumnSpec('service_name', missing=NOT_AVAILABLE, fill='N/A', dtype=CATEGORY),
+    ColumnSpec('service_subtype', missing=NOT_AVAILABLE, fill='', clean=per_unique(humanize_label), dtype=CATEGORY),
+    ColumnSpec('service_details', derive=encampment_details, clean=per_unique(humanize_label), dtype=CATEGORY),
+    ColumnSpec('source', missing=NOT_AVAILABLE, fill='N/A', dtype=CATEGORY),
+    ColumnSpec('agency_responsible', missing=NOT_AVAILABLE, fill='N/A', dtype=CATEGORY),
+    ColumnSpec('count', dtype=COUNT, optional=True),
+]
 
 # Configuration for 311 maps
 # NOTE: Titles are NOT set by code - edit them directly in Datawrapper
+# Each config may set "domain" to query another Socrata portal (default data.sfgov.org)
+# plus "source_name"/"source_url" to credit it; different domains are updated concurrently.
+# Dense maps may set "aggregate_grid" (cell size in degrees, e.g. 0.002) to fetch one
+# point per grid cell, sized by its request count, instead of every request. Grid maps only
+# have the cell's {{ count }} and latest time, so they need an "aggregate_tooltip_template".
 MAP_CONFIGS = {
     "street_cleaning_map": {
         "dataset_id": "vw6y-z8j6",
@@ -225,8 +203,20 @@ MAP_CONFIGS = {
     }
 }
 
-def get_map_data_from_datasf(chart_config):
-    """Fetch location data from DataSF API for the most recent complete day."""
+def map_contract(chart_config):
+    """Checks every fetched row must pass before it is mapped (see validation.py)"""
+    return coordinate_checks('lat', 'long', map_bounds(chart_config)) + [
+        timestamp_check('requested_datetime'),
+        range_check('supervisor_district', 1, 11),
+    ]
+
+def fetch_map_records(chart_config):
+    """Fetch the raw location rows for the most recent complete day from DataSF."""
+    client = socrata_for(chart_config)
+    
+    # Give DataSF time to load all of yesterday's requests for this service before picking the day to map
+    wait_for_fresh(client, chart_config['dataset_id'], 'requested_datetime', expected_day(),
+                   where=chart_config['service_filter'])
     
     # First, find the latest date in the dataset
     latest_date_query = f"""
@@ -247,17 +237,18 @@ def get_map_data_from_datasf(chart_config):
         latest_date = datetime.fromisoformat(latest_result[0]['requested_datetime'].split('T')[0])
         logging.info(f"Latest data available is from: {latest_date.strftime('%Y-%m-%d')}")
         
-        # Use the last complete day
-        end_date = latest_date.replace(hour=23, minute=59, second=59)
+        # Use the last complete day - today is still loading, so never map past the expected day
+        map_day = day_to_map(latest_date, expected_day())
+        end_date = datetime.combine(map_day, datetime.max.time()).replace(microsecond=0)
         # For maps, we want data from the most recent complete day
         # So we query for data from yesterday (start_date) to latest_date (end_date)
         start_date = end_date.replace(hour=0, minute=0, second=0)  # Start of the last complete day
         
     except Exception as e:
         logging.error(f"Error finding latest date, falling back to default date range: {str(e)}")
-        # Fallback: use previous day
-        end_date = datetime.now().replace(hour=23, minute=59, second=59) - timedelta(days=1)
-        start_date = end_date - timedelta(days=1)
+        # Fallback: use the expected day (yesterday)
+        end_date = datetime.combine(expected_day(), datetime.max.time()).replace(microsecond=0)
+        start_date = end_date.replace(hour=0, minute=0, second=0)
     
     # Format dates for query - end date should be next day for < comparison
     start_date_str = start_date.strftime('%Y-%m-%d')
@@ -265,8 +256,19 @@ def get_map_data_from_datasf(chart_config):
     
     logging.info(f"Querying data for {start_date_str}")
     
-    # Base query
-    base_query = f"""
+    where_clause = f"""{chart_config['service_filter']}
+        AND requested_datetime >= '{start_date_str}'
+        AND requested_datetime < '{end_date_str}'
+        AND lat IS NOT NULL
+        AND long IS NOT NULL"""
+    
+    grid = chart_config.get('aggregate_grid')
+    if grid:
+        # Pre-aggregate server-side: one row per grid cell with a count and its latest requested_datetime
+        base_query = build_grid_query('lat', 'long', grid, 'requested_datetime', where_clause)
+    else:
+        # Base query
+        base_query = f"""
     SELECT 
         lat,
         long,
@@ -282,11 +284,7 @@ def get_map_data_from_datasf(chart_config):
         source,
         agency_responsible
     WHERE 
-        {chart_config['service_filter']}
-        AND requested_datetime >= '{start_date_str}'
-        AND requested_datetime < '{end_date_str}'
-        AND lat IS NOT NULL
-        AND long IS NOT NULL
+        {where_clause}
     ORDER BY requested_datetime DESC
     """
     
@@ -339,123 +337,63 @@ def get_map_data_from_datasf(chart_config):
                 
             offset += limit
             
+        except CircuitOpenError:
+            # Never publish a partial page set because the host went down mid-fetch
+            raise
         except Exception as e:
             logging.error(f"Error fetching data from DataSF at offset {offset}: {str(e)}")
             break
     
     df = pd.DataFrame.from_records(all_results)
+    del all_results  # the frame holds the rows now; free the per-row dicts before the transform
+    return df, end_date
+
+def transform_map_data(df, end_date, chart_config):
+    """Turn the raw DataSF rows into the publish-ready map frame."""
+    grid = chart_config.get('aggregate_grid')
+    if grid and not df.empty:
+        df = to_cell_centers(df, grid, 'lat', 'long')
     
-    # Initialize final_df as empty DataFrame with required columns
-    required_cols = [
-        'lat', 'long', 'status', 'address', 'reported_datetime', 'hours_ago',
-        'neighborhood', 'district', 'service_name', 'service_subtype',
-        'service_details', 'source', 'agency_responsible'
-    ]
-    final_df = pd.DataFrame(columns=required_cols)
+    # Rows with bad coordinates or timestamps go to the quarantine file instead of the map
+    df = quarantine_invalid(df, map_contract(chart_config), chart_config['chart_id'])
+    
+    # Grid cells have no per-request fields, only the count and latest time
+    columns = grid_specs(MAP_COLUMNS, ('lat', 'long', 'reported_datetime', 'hours_ago')) if grid else MAP_COLUMNS
+    final_df = empty_frame(columns)
     
     if not df.empty:
         # Convert datetime
         df['requested_datetime'] = pd.to_datetime(df['requested_datetime'])
         
         # Prepare columns for the final dataset - use AP Style datetime
-        df['reported_datetime'] = df['requested_datetime'].apply(format_datetime_ap_style)
+        df['reported_datetime'] = ap_datetime_column(df['requested_datetime'])
         end_date_ts = pd.Timestamp(end_date)
         # Keep hours_ago for data but don't display in tooltip
         df['hours_ago'] = ((end_date_ts - df['requested_datetime']).dt.total_seconds() / 3600).round(1)
         
-        # Handle potential missing columns and values
         # First, log the actual columns we have
         logging.info(f"Actual columns in response: {df.columns.tolist()}")
         
-        # Add missing columns with default values if they don't exist
-        required_columns = [
-            'neighborhoods_sffind_boundaries', 'supervisor_district', 
-            'service_subtype', 'service_details', 'source', 'service_name',
-            'agency_responsible'
-        ]
-        
-        for col in required_columns:
-            if col not in df.columns:
-                logging.warning(f"Column '{col}' not found in response, adding with default values")
-                df[col] = 'Not Available'
-        
-        # Now fill missing values in existing columns
-        df['neighborhoods_sffind_boundaries'] = df['neighborhoods_sffind_boundaries'].fillna('N/A')
-        df['supervisor_district'] = df['supervisor_district'].fillna('N/A')
-        df['service_subtype'] = df['service_subtype'].fillna('') # Use empty string if preferred
-        df['service_details'] = df['service_details'].fillna('')
-        df['source'] = df['source'].fillna('N/A')
-        df['service_name'] = df['service_name'].fillna('N/A')
-        df['agency_responsible'] = df['agency_responsible'].fillna('N/A')
-        
-        # For encampment reports specifically, use a default value if service_details is empty
-        encampment_mask = (df['service_name'] == 'Encampment') | (df['service_name'] == 'Encampments')
-        df.loc[encampment_mask & df['service_details'].isin(['', None, 'Not Available']), 'service_details'] = 'Encampment reported'
-        
-        # Format service_details and service_subtype:
-        # 1. Replace underscores with spaces
-        # 2. Capitalize only the first letter of the string (sentence case)
-        df['service_details'] = df['service_details'].str.replace('_', ' ').apply(lambda x: x.capitalize() if isinstance(x, str) and x else x)
-        df['service_subtype'] = df['service_subtype'].str.replace('_', ' ').apply(lambda x: x.capitalize() if isinstance(x, str) and x else x)
-        
-        # Format neighborhood with title case (proper capitalization)
-        df['neighborhoods_sffind_boundaries'] = df['neighborhoods_sffind_boundaries'].apply(
-            lambda x: x.title() if isinstance(x, str) else x
-        )
-        
-        # Format address with proper capitalization and simplification
-        def format_address(addr):
-            if not isinstance(addr, str):
-                return addr
-                
-            # Special handling for address abbreviations
-            common_abbr = {'St': 'ST', 'Ave': 'AVE', 'Blvd': 'BLVD', 'Rd': 'RD', 'Dr': 'DR', 
-                          'Ln': 'LN', 'Ct': 'CT', 'Pl': 'PL', 'Hwy': 'HWY'}
-            
-            # Get only the first part (street address) - everything before the first comma
-            parts = addr.split(',')
-            street_address = parts[0].strip() if parts else addr
-            
-            # Title case the street address
-            street_address = street_address.title()
-            
-            # Fix abbreviations in street address
-            for abbr, upper in common_abbr.items():
-                street_address = street_address.replace(f" {abbr}", f" {upper}")
-                street_address = street_address.replace(f" {abbr}.", f" {upper}")
-            
-            # Return only the street address part
-            return street_address
-            
-        df['address'] = df['address'].apply(format_address)
-        
-        # Create final DataFrame with specific columns
-        final_df = pd.DataFrame({
-            'lat': df['lat'].astype(float),
-            'long': df['long'].astype(float),
-            'status': df['status_description'],
-            'address': df['address'],
-            'reported_datetime': df['reported_datetime'],
-            'hours_ago': df['hours_ago'],
-            'neighborhood': df['neighborhoods_sffind_boundaries'],
-            'district': df['supervisor_district'],
-            'service_name': df['service_name'],
-            'service_subtype': df['service_subtype'],
-            'service_details': df['service_details'],
-            'source': df['source'],
-            'agency_responsible': df['agency_responsible']
-        })
-        
-        # Ensure the DataFrame has the correct column order (optional but good practice)
-        final_df = final_df[required_cols]
+        # Missing columns, null fills and text cleanup are declared in MAP_COLUMNS
+        final_df = build_frame(df, columns)
         
         # Log the first few rows to verify format
         logging.info(f"Sample of final data:\n{final_df.head().to_string()}")
         
+    return final_df
+
+def get_map_data_from_datasf(chart_config):
+    """Fetch location data from DataSF API for the most recent complete day."""
+    with fetch_lock(chart_config):
+        df, end_date = fetch_map_records(chart_config)
+    
+    # String-heavy cleanup; runs in a worker process when the transform pool is on
+    final_df = run_transform(transform_map_data, df, end_date, chart_config)
+    
     logging.info(f"Retrieved total of {len(final_df)} locations from DataSF")
     return final_df, end_date
 
-def update_datawrapper_map(chart_id, data, config, latest_date):
+def update_datawrapper_map(chart_id, data, config, latest_date, template=None):
     """Update a Datawrapper map with new location data"""
     try:
         logger.info(f"Updating Datawrapper map {chart_id}")
@@ -464,29 +402,16 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         if not all(col in data.columns for col in ['lat', 'long', 'status']):
             raise ValueError(f"Missing required columns. Found: {data.columns.tolist()}")
         
-        # Create a new DataFrame with Datawrapper's expected column names
-        dw_data = pd.DataFrame({
-            'latitude': pd.to_numeric(data['lat'], errors='coerce'),
-            'longitude': pd.to_numeric(data['long'], errors='coerce'),
-            'status': data['status'],
-            'address': data['address'],
-            'reported_datetime': data['reported_datetime'],
-            'hours_ago': data['hours_ago'],
-            'neighborhood': data['neighborhood'],
-            'district': data['district'],
-            'service_name': data['service_name'],
-            'service_subtype': data['service_subtype'],
-            'service_details': data['service_details'],
-            'source': data['source'],
-            'agency_responsible': data['agency_responsible']
-        })
+        # Datawrapper's expected column names, without rows that have invalid lat/long
+        dw_data = datawrapper_frame(data, MAP_COLUMNS)
         
-        # Drop any rows with invalid lat/long
-        dw_data = dw_data.dropna(subset=['latitude', 'longitude'])
-        
-        # FIRST: Fetch current chart metadata to preserve custom settings
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
+        # Settings come from this run's template snapshot (a private copy - every map shares it);
+        # without one, fetch the chart's own metadata to preserve its custom settings
+        template = load_template(template)
+        if template:
+            current_metadata = copy.deepcopy(template)
+        else:
+            current_metadata = get_datawrapper().get_chart(chart_id).get('metadata', {})
         
         # Get current visualization settings (especially preserving status-based colors)
         current_viz_settings = current_metadata.get('visualize', {})
@@ -498,14 +423,14 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         
         # Build description from template
         description_template = config.get('description_template', "Showing {count} reports from {date}.")
-        description = description_template.format(count=f"{len(dw_data):,}", date=query_date_ap)
+        description = description_template.format(count=f"{incident_total(dw_data):,}", date=query_date_ap)
         
         # Start with essential metadata we always want to update
         # NOTE: We do NOT set the title here - titles are managed directly in Datawrapper
         metadata = {
             "describe": {
-                "source-name": "DataSF",
-                "source-url": "https://datasf.org/opendata/",
+                "source-name": config.get("source_name", "DataSF"),
+                "source-url": config.get("source_url", "https://datasf.org/opendata/"),
                 "intro": description,
                 "byline": "San Francisco Examiner"
             },
@@ -578,8 +503,17 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
                 "color": "status"
             }
         
+        # The template's mapping and axes go out in the same metadata update
+        if template:
+            metadata["mapping"] = current_metadata.get('mapping') or metadata["mapping"]
+            metadata["axes"] = current_metadata.get('axes', {})
+        
+        # Grid cells are drawn bigger the more requests they hold
+        if config.get('aggregate_grid'):
+            size_by_count(metadata)
+        
         # Apply custom tooltip template from config (overrides preserved settings)
-        tooltip_template = config.get('tooltip_template')
+        tooltip_template = tooltip_template_for(config)
         if tooltip_template:
             if "visualize" not in metadata:
                 metadata["visualize"] = {}
@@ -593,35 +527,19 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
             }
             logger.info(f"Applied custom tooltip template to {chart_id}")
         
-        # Update chart metadata (title is NOT set - manage titles directly in Datawrapper)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Updated map metadata for {chart_id} (preserving custom settings, title unchanged)")
-
-        # Update the data using direct API call with proper encoding
-        api_token = DATAWRAPPER_API_KEY
-        csv_content = dw_data.to_csv(index=False)
-        
-        response = requests.put(
-            f"https://api.datawrapper.de/v3/charts/{chart_id}/data",
-            headers={
-                "Authorization": f"Bearer {api_token}",
-                "Content-Type": "text/csv; charset=utf-8"
-            },
-            data=csv_content.encode('utf-8')
-        )
-        
-        if response.status_code != 204:
-            logger.error(f"Error uploading data: {response.status_code} {response.text}")
-            raise Exception(f"Failed to upload data: {response.status_code}")
-        logger.info(f"Uploaded data columns for {chart_id} via API")
-
-        # Publish map
-        dw.publish_chart(chart_id)
-        
-        map_info = dw.get_chart(chart_id)
-        published_url = map_info.get("publicUrl", "Unknown URL")
-        
-        logger.info(f"Map published successfully: {published_url}")
+        # Leave the map alone if neither the data nor the metadata changed since the last publish
+        csv_content = csv_bytes(dw_data)
+        current = publish_state.fingerprint(csv_content, metadata)
+        if publish_state.unchanged(chart_id, current):
+            logger.info(f"Map {chart_id} unchanged since last publish, skipping upload")
+            return publish_state.public_url(chart_id)
+        
+        # One metadata update, one data upload and one publish (title is NOT set - manage titles
+        # directly in Datawrapper); with PUBLISH_QUEUE=1 the queue worker makes them later
+        published_url = publish_queue.publish(chart_id, csv_content, metadata, current,
+                                              intro=description, as_of=format_date_ap_style(latest_date))
+        if not publish_queue.enabled():
+            logger.info(f"Map published successfully: {published_url}")
         return published_url
     
     except Exception as e:
@@ -632,6 +550,7 @@ def save_map_template(source_chart_id, template_file="map_template.json"):
     """
     Save the current visualization settings from a working map to a template file
     """
+    dw = get_datawrapper()
     try:
         # Get current chart settings
         current_chart = dw.get_chart(source_chart_id)
@@ -655,68 +574,32 @@ def save_map_template(source_chart_id, template_file="map_template.json"):
         logger.error(f"Error saving map template: {e}")
         raise
 
-def apply_map_template(chart_id, template_file="map_template.json", intro=None, tooltip_template=None):
-    """
-    Apply saved template settings to another map.
-    NOTE: Titles are NOT set here - manage titles directly in Datawrapper.
-    """
+def publish_map_update(config_name, data, latest_date, template_file=None):
+    """Upload and publish a map's data, falling back to its last good payload if that fails"""
+    config = MAP_CONFIGS[config_name]
     try:
-        # Load template settings
-        if isinstance(template_file, dict):
-            # Template is already loaded as dict
-            template = template_file
-        else:
-            # Load template from file
-            with open(template_file, 'r') as f:
-                template = json.load(f)
-        
-        # Get current chart metadata
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
-        
-        # Create new metadata with template settings
-        metadata = {
-            "visualize": template.get('visualize', {}),
-            "mapping": template.get('mapping', {}),
-            "axes": template.get('axes', {})
-        }
-        
-        # Update describe section with current values (preserves existing title)
-        metadata["describe"] = current_metadata.get('describe', {})
-        
-        # Update intro/description if provided
-        if intro:
-            metadata["describe"]["intro"] = intro
-        
-        # Apply custom tooltip template if provided
-        if tooltip_template:
-            # Force create visualize.tooltip if it doesn't exist
-            if "tooltip" not in metadata["visualize"]:
-                metadata["visualize"]["tooltip"] = {}
-            
-            # Set the tooltip template with full HTML
-            metadata["visualize"]["tooltip"] = {
-                "title": "",  # Clear the title field - we include title in body HTML
-                "body": tooltip_template,
-                "html": True,
-                "style": "custom",
-                "sticky": True,
-                "enabled": True
-            }
-            
-            logger.info(f"Applied custom tooltip template to chart {chart_id}")
-            
-        # Apply the settings (title is NOT updated)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Applied template settings to chart {chart_id}")
-        
-        return True
-        
+        published_url = update_datawrapper_map(
+            chart_id=config["chart_id"],
+            data=data,
+            config=config,
+            latest_date=latest_date,
+            template=template_file
+        )
+        logger.info(f"Successfully updated {config_name} map")
+        return published_url
+    
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
+        raise
     except Exception as e:
-        logger.error(f"Error applying map template: {e}")
+        import traceback
+        logger.error(f"Failed to update {config_name} map: {e}")
+        logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
         raise
 
-def process_and_update_map(config_name, template_file=None):
+def process_and_update_map(config_name, template_file=None, publisher=None):
     """Process data and update a specific map"""
     config = MAP_CONFIGS[config_name]
     if not config["chart_id"]:
@@ -729,54 +612,33 @@ def process_and_update_map(config_name, template_file=None):
         
         # Log data columns to help debug
         logger.info(f"{config_name} data columns: {data.columns.tolist()}")
-        logger.info(f"{config_name} has {len(data)} records")
+        logger.info(f"{config_name} has {len(data)} records ({incident_total(data)} incidents)")
         
         if len(data) == 0:
-            logger.warning(f"No data available for {config_name}, skipping update")
+            logger.warning(f"No data available for {config_name}, serving last good payload")
+            last_good.serve_stale(config_name, config["chart_id"])
             return
         
-        # Update map
-        update_datawrapper_map(
-            chart_id=config["chart_id"],
-            data=data,
-            config=config,
-            latest_date=latest_date
-        )
-        
-        # Apply template settings if provided and this is not the source map
-        if template_file and config["chart_id"] != "nB5JE":  # Assuming nB5JE is the source
-            # Use AP Style date formatting
-            query_date_ap = format_date_ap_style(latest_date)
-            
-            # Build description from template
-            description_template = config.get('description_template', "Showing {count} reports from {date}.")
-            description = description_template.format(count=f"{len(data):,}", date=query_date_ap)
-            
-            # Get the specific tooltip template for this map
-            tooltip_template = config.get('tooltip_template')
-            
-            # Log the tooltip template being used
-            logger.info(f"Applying tooltip template for {config_name}: {tooltip_template[:50]}...")
-            
-            # Apply template with the map-specific tooltip (title is NOT set)
-            apply_map_template(
-                chart_id=config["chart_id"],
-                template_file=template_file,
-                intro=description,
-                tooltip_template=tooltip_template
-            )
-        
-        logger.info(f"Successfully updated {config_name} map")
+        # Upload and publish on the publisher's threads, so this map renders while the next one is fetched
+        publisher = publisher or Publisher(workers=1)
+        publisher.submit(config["chart_id"], publish_map_update, config_name, data, latest_date, template_file)
     
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
     except Exception as e:
         import traceback
         logger.error(f"Failed to update {config_name} map: {e}")
         logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
 
 def update_all_maps():
     """Update all configured maps"""
     logger.info("Starting scheduled update of all maps")
     
+    # Transform workers start before any fetch or publish threads do
+    start_pool()
+    
     # First, save template from the working map
     template = None
     try:
@@ -785,10 +647,14 @@ def update_all_maps():
     except Exception as e:
         logger.warning(f"Could not save template, will use default settings: {e}")
     
-    # Then update all maps using the template
-    for map_name in MAP_CONFIGS:
-        process_and_update_map(map_name, template)
+    # Then update all maps using the template, publishing several at once
+    with Publisher() as publisher:
+        run_configs(MAP_CONFIGS, lambda map_name: process_and_update_map(map_name, template, publisher))
+    
+    # Retry maps that fell back to their last good payload (publishing inline)
+    last_good.revalidate(lambda map_name: process_and_update_map(map_name, template))
         
+    log_summary(logger)
     logger.info("Completed update of all maps")
 
 if __name__ == "__main__":
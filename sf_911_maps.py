@@ -2,16 +2,30 @@
 # DataSF to Datawrapper Automation Pipeline - 911 Call Maps
 # For San Francisco Examiner
 
-import os
 import pandas as pd
-from sodapy import Socrata
-import datawrapper
 import logging
 from datetime import datetime, timedelta
-import requests
+import copy
 import json
 import re
 
+from addresses import normalize_street_address
+from ap_style import ap_datetime_column, format_date_ap_style, format_date_range_ap_style
+from circuit_breaker import CircuitOpenError, log_summary
+from clients import fetch_lock, get_datawrapper, socrata_for
+from column_spec import ColumnSpec, build_frame, csv_bytes, datawrapper_frame, empty_frame
+from dtype_plan import CATEGORY, COORDINATE, COUNT, DURATION, TEXT
+import last_good
+from map_publish import load_template
+import publish_queue
+import publish_state
+from publisher import Publisher
+from spatial_aggregation import (build_grid_query, grid_specs, incident_total, size_by_count,
+                                 to_cell_centers, tooltip_template_for)
+from transform_pool import run_configs, run_transform, start_pool
+from unique_transform import per_unique, title_case_or_unknown
+from validation import coordinate_checks, enum_check, map_bounds, quarantine_invalid, timestamp_check
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,49 +38,36 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style.
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
-
-
-def format_date_range_ap_style(start_dt, end_dt):
-    """
-    Format a date range in AP Style.
-    - If same month: "Jan. 15-21, 2025"
-    - If different months: "Jan. 28 - Feb. 3, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    
-    if start_dt.month == end_dt.month and start_dt.year == end_dt.year:
-        return f"{ap_months[start_dt.month]} {start_dt.day}-{end_dt.day}, {end_dt.year}"
-    else:
-        return f"{ap_months[start_dt.month]} {start_dt.day} - {ap_months[end_dt.month]} {end_dt.day}, {end_dt.year}"
-
-# API Credentials
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DATASF_APP_TOKEN = os.environ.get("DATASF_APP_TOKEN", "xdboBmIBQtjISZqIRYDWjKyxY")
+# Output columns of the map frame and the Datawrapper CSV (see column_spec.py)
+MAP_COLUMNS = [
+    ColumnSpec('lat', source='latitude', dtype=COORDINATE, csv_name='latitude'),
+    ColumnSpec('long', source='longitude', dtype=COORDINATE, csv_name='longitude'),
+    ColumnSpec('incident_category', fill='Unknown', dtype=CATEGORY),
+    ColumnSpec('incident_subcategory', fill='Unknown', dtype=CATEGORY),
+    ColumnSpec('incident_address', source='intersection', missing='Unknown Location', fill='Unknown Location',
+               clean=normalize_street_address, dtype=TEXT),
+    ColumnSpec('incident_datetime', source='formatted_datetime', dtype=TEXT),
+    ColumnSpec('days_ago', dtype=DURATION),
+    ColumnSpec('neighborhood', source='analysis_neighborhood', missing='Unknown',
+               clean=per_unique(title_case_or_unknown), dtype=CATEGORY),
+    ColumnSpec('district', source='police_district', fill='Unknown', dtype=CATEGORY),
+    ColumnSpec('resolution', fill='Open/Pending', dtype=CATEGORY),
+    ColumnSpec('count', dtype=COUNT, optional=True),
+]
 
-# Initialize API clients
-dw = datawrapper.Datawrapper(access_token=DATAWRAPPER_API_KEY)
-client = Socrata("data.sfgov.org", DATASF_APP_TOKEN)
+# SFPD districts; incidents coded "Out of SF" are quarantined
+POLICE_DISTRICTS = [
+    'Bayview', 'Central', 'Ingleside', 'Mission', 'Northern',
+    'Park', 'Richmond', 'Southern', 'Taraval', 'Tenderloin'
+]
 
 # Configuration for 911 maps
 # Source dataset: https://data.sfgov.org/Public-Safety/Police-Department-Incident-Reports-2018-to-Present/wg3w-h783
+# Each config may set "domain" to query another Socrata portal (default data.sfgov.org)
+# plus "source_name"/"source_url" to credit it; different domains are updated concurrently.
+# Dense maps may set "aggregate_grid" (cell size in degrees, e.g. 0.002) to fetch one
+# point per grid cell, sized by its incident count, instead of every incident. Grid maps only
+# have the cell's {{ count }} and latest time, so they need an "aggregate_tooltip_template".
 MAP_CONFIGS = {
     "violent_crimes_map": {
         "dataset_id": "wg3w-h783", # Police Department Incident Reports 2018 to Present
@@ -98,6 +99,12 @@ MAP_CONFIGS = {
 <b>Neighborhood:</b><br>{{ PROPER(neighborhood) }}<br>
 <b>Status:</b> {{ resolution }}<br>
 <b>Reported:</b> {{ incident_datetime }}
+</div>""",
+        # Thousands of thefts a week; one point per ~200 m cell, sized by its count
+        "aggregate_grid": 0.002,
+        "aggregate_tooltip_template": """<div style="font-family:Arial,sans-serif;line-height:1.3;">
+<b>{{ count }} property crime {{ count == 1 ? 'incident' : 'incidents' }}</b><br>
+<b>Latest:</b> {{ incident_datetime }}
 </div>"""
     },
     "drug_offenses_map": {
@@ -150,8 +157,16 @@ MAP_CONFIGS = {
     }
 }
 
-def get_map_data_from_datasf(chart_config):
-    """Fetch incident data from DataSF API for the most recent complete day."""
+def map_contract(chart_config):
+    """Checks every fetched row must pass before it is mapped (see validation.py)"""
+    return coordinate_checks('latitude', 'longitude', map_bounds(chart_config)) + [
+        timestamp_check('incident_datetime'),
+        enum_check('police_district', POLICE_DISTRICTS),
+    ]
+
+def fetch_map_records(chart_config):
+    """Fetch the raw incident rows for the most recent complete day from DataSF."""
+    client = socrata_for(chart_config)
     
     # First, find the latest date in the dataset
     latest_date_query = f"""
@@ -188,8 +203,19 @@ def get_map_data_from_datasf(chart_config):
     
     logging.info(f"Querying data from {start_date_str} to {end_date_str}")
     
-    # Base query
-    base_query = f"""
+    where_clause = f"""({chart_config['incident_filter']})
+        AND incident_date >= '{start_date_str}'
+        AND incident_date <= '{end_date_str}'
+        AND latitude IS NOT NULL
+        AND longitude IS NOT NULL"""
+    
+    grid = chart_config.get('aggregate_grid')
+    if grid:
+        # Pre-aggregate server-side: one row per grid cell with a count and its latest incident_datetime
+        base_query = build_grid_query('latitude', 'longitude', grid, 'incident_datetime', where_clause)
+    else:
+        # Base query
+        base_query = f"""
     SELECT 
         latitude,
         longitude,
@@ -218,11 +244,7 @@ def get_map_data_from_datasf(chart_config):
         supervisor_district,
         supervisor_district_2012
     WHERE 
-        ({chart_config['incident_filter']})
-        AND incident_date >= '{start_date_str}'
-        AND incident_date <= '{end_date_str}'
-        AND latitude IS NOT NULL
-        AND longitude IS NOT NULL
+        {where_clause}
     ORDER BY incident_datetime DESC
     """
     
@@ -276,74 +298,62 @@ def get_map_data_from_datasf(chart_config):
                 
             offset += limit
             
+        except CircuitOpenError:
+            # Never publish a partial page set because the host went down mid-fetch
+            raise
         except Exception as e:
             logging.error(f"Error fetching data from DataSF at offset {offset}: {str(e)}")
             break
     
     df = pd.DataFrame.from_records(all_results)
+    del all_results  # the frame holds the rows now; free the per-row dicts before the transform
+    return df, end_date
+
+def transform_map_data(df, end_date, chart_config):
+    """Turn the raw DataSF rows into the publish-ready map frame."""
+    grid = chart_config.get('aggregate_grid')
+    if grid and not df.empty:
+        df = to_cell_centers(df, grid, 'latitude', 'longitude')
     
-    # Initialize final_df as empty DataFrame with required columns
-    required_cols = [
-        'lat', 'long', 'incident_datetime', 'incident_address',
-        'neighborhood', 'district', 'incident_category',
-        'incident_subcategory', 'resolution'
-    ]
-    final_df = pd.DataFrame(columns=required_cols)
+    # Rows with bad coordinates or timestamps go to the quarantine file instead of the map
+    df = quarantine_invalid(df, map_contract(chart_config), chart_config['chart_id'])
+    
+    # Grid cells have no per-incident fields, only the count and latest time
+    columns = grid_specs(MAP_COLUMNS, ('lat', 'long', 'incident_datetime', 'days_ago')) if grid else MAP_COLUMNS
+    final_df = empty_frame(columns)
     
     if not df.empty:
         # Convert datetime
         df['incident_datetime'] = pd.to_datetime(df['incident_datetime'])
         
-        # Prepare columns for the final dataset
-        df['formatted_datetime'] = df['incident_datetime'].dt.strftime('%B %d, %Y %I:%M %p')
+        # Prepare columns for the final dataset - use AP Style datetime
+        df['formatted_datetime'] = ap_datetime_column(df['incident_datetime'])
         end_date_ts = pd.Timestamp(end_date)
         df['days_ago'] = ((end_date_ts - df['incident_datetime']).dt.total_seconds() / 86400).round(1)
         
-        # Handle potential missing columns and values
         # First, log the actual columns we have
         logging.info(f"Actual columns in response: {df.columns.tolist()}")
         
-        # Format neighborhood with title case (proper capitalization)
-        if 'analysis_neighborhood' in df.columns:
-            df['analysis_neighborhood'] = df['analysis_neighborhood'].apply(
-                lambda x: x.title() if isinstance(x, str) else 'Unknown'
-            )
-        else:
-            df['analysis_neighborhood'] = 'Unknown'
-        
-        # Create incident_address from intersection if available
-        if 'intersection' in df.columns:
-            df['incident_address'] = df['intersection'].fillna('Unknown Location')
-        else:
-            df['incident_address'] = 'Unknown Location'
-        
-        # Fill missing values for required columns
-        df['resolution'] = df['resolution'].fillna('Open/Pending')
-        df['incident_category'] = df['incident_category'].fillna('Unknown')
-        df['incident_subcategory'] = df['incident_subcategory'].fillna('Unknown')
-        df['police_district'] = df['police_district'].fillna('Unknown')
-        
-        # Create final DataFrame with specific columns
-        final_df = pd.DataFrame({
-            'lat': df['latitude'].astype(float),
-            'long': df['longitude'].astype(float),
-            'incident_datetime': df['formatted_datetime'],
-            'incident_address': df['incident_address'],
-            'neighborhood': df['analysis_neighborhood'],
-            'district': df['police_district'],
-            'incident_category': df['incident_category'],
-            'incident_subcategory': df['incident_subcategory'],
-            'resolution': df['resolution'],
-            'days_ago': df['days_ago']
-        })
+        # Missing columns, null fills and text cleanup are declared in MAP_COLUMNS
+        final_df = build_frame(df, columns)
         
         # Log the first few rows to verify format
         logging.info(f"Sample of final data:\n{final_df.head().to_string()}")
         
+    return final_df
+
+def get_map_data_from_datasf(chart_config):
+    """Fetch incident data from DataSF API for the most recent complete day."""
+    with fetch_lock(chart_config):
+        df, end_date = fetch_map_records(chart_config)
+    
+    # String-heavy cleanup; runs in a worker process when the transform pool is on
+    final_df = run_transform(transform_map_data, df, end_date, chart_config)
+    
     logging.info(f"Retrieved total of {len(final_df)} incidents from DataSF")
     return final_df, end_date
 
-def update_datawrapper_map(chart_id, data, config, latest_date):
+def update_datawrapper_map(chart_id, data, config, latest_date, template=None):
     """Update a Datawrapper map with new incident data"""
     try:
         logger.info(f"Updating Datawrapper map {chart_id}")
@@ -352,26 +362,16 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         if not all(col in data.columns for col in ['lat', 'long']):
             raise ValueError(f"Missing required columns. Found: {data.columns.tolist()}")
         
-        # Create a new DataFrame with Datawrapper's expected column names
-        dw_data = pd.DataFrame({
-            'latitude': pd.to_numeric(data['lat'], errors='coerce'),
-            'longitude': pd.to_numeric(data['long'], errors='coerce'),
-            'incident_category': data['incident_category'],
-            'incident_subcategory': data['incident_subcategory'],
-            'incident_address': data['incident_address'],
-            'incident_datetime': data['incident_datetime'],
-            'days_ago': data['days_ago'],
-            'neighborhood': data['neighborhood'],
-            'district': data['district'],
-            'resolution': data['resolution']
-        })
+        # Datawrapper's expected column names, without rows that have invalid lat/long
+        dw_data = datawrapper_frame(data, MAP_COLUMNS)
         
-        # Drop any rows with invalid lat/long
-        dw_data = dw_data.dropna(subset=['latitude', 'longitude'])
-        
-        # FIRST: Fetch current chart metadata to preserve custom settings
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
+        # Settings come from this run's template snapshot (a private copy - every map shares it);
+        # without one, fetch the chart's own metadata to preserve its custom settings
+        template = load_template(template)
+        if template:
+            current_metadata = copy.deepcopy(template)
+        else:
+            current_metadata = get_datawrapper().get_chart(chart_id).get('metadata', {})
         
         # Get current visualization settings
         current_viz_settings = current_metadata.get('visualize', {})
@@ -383,16 +383,16 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         
         # Build description - placeholder for now, will be customized per map
         description = config.get('description_template', f"Showing {{count}} incidents from {{date_range}}.").format(
-            count=f"{len(dw_data):,}",
+            count=f"{incident_total(dw_data):,}",
             date_range=query_date_range_ap
-        ) if 'description_template' in config else f"Showing {len(dw_data):,} incidents from {query_date_range_ap}."
+        ) if 'description_template' in config else f"Showing {incident_total(dw_data):,} incidents from {query_date_range_ap}."
         
         # Start with essential metadata we always want to update
         # NOTE: Title is NOT set here - manage titles directly in Datawrapper
         metadata = {
             "describe": {
-                "source-name": "DataSF - Police Department Incident Reports",
-                "source-url": "https://data.sfgov.org/Public-Safety/Police-Department-Incident-Reports-2018-to-Present/wg3w-h783",
+                "source-name": config.get("source_name", "DataSF - Police Department Incident Reports"),
+                "source-url": config.get("source_url", "https://data.sfgov.org/Public-Safety/Police-Department-Incident-Reports-2018-to-Present/wg3w-h783"),
                 "intro": description,
                 "byline": "San Francisco Examiner"
             },
@@ -458,35 +458,43 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
                 "color": "incident_category"
             }
         
-        # Update chart (title is NOT set - manage titles directly in Datawrapper)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Updated map metadata for {chart_id} (preserving custom settings)")
-
-        # Update the data using direct API call with proper encoding
-        api_token = DATAWRAPPER_API_KEY
-        csv_content = dw_data.to_csv(index=False)
+        # The template's mapping and axes go out in the same metadata update
+        if template:
+            metadata["mapping"] = current_metadata.get('mapping') or metadata["mapping"]
+            metadata["axes"] = current_metadata.get('axes', {})
         
-        response = requests.put(
-            f"https://api.datawrapper.de/v3/charts/{chart_id}/data",
-            headers={
-                "Authorization": f"Bearer {api_token}",
-                "Content-Type": "text/csv; charset=utf-8"
-            },
-            data=csv_content.encode('utf-8')
-        )
+        # Grid cells are drawn bigger the more incidents they hold
+        if config.get('aggregate_grid'):
+            size_by_count(metadata)
         
-        if response.status_code != 204:
-            logger.error(f"Error uploading data: {response.status_code} {response.text}")
-            raise Exception(f"Failed to upload data: {response.status_code}")
-        logger.info(f"Uploaded data columns for {chart_id} via API")
-
-        # Publish map
-        dw.publish_chart(chart_id)
-        
-        map_info = dw.get_chart(chart_id)
-        published_url = map_info.get("publicUrl", "Unknown URL")
-        
-        logger.info(f"Map published successfully: {published_url}")
+        # Apply custom tooltip template from config (overrides preserved settings)
+        tooltip_template = tooltip_template_for(config)
+        if tooltip_template:
+            if "visualize" not in metadata:
+                metadata["visualize"] = {}
+            metadata["visualize"]["tooltip"] = {
+                "title": "",  # Clear the title field - we include title in body HTML
+                "body": tooltip_template,
+                "html": True,
+                "style": "custom",
+                "sticky": True,
+                "enabled": True
+            }
+            logger.info(f"Applied custom tooltip template to {chart_id}")
+        
+        # Leave the map alone if neither the data nor the metadata changed since the last publish
+        csv_content = csv_bytes(dw_data)
+        current = publish_state.fingerprint(csv_content, metadata)
+        if publish_state.unchanged(chart_id, current):
+            logger.info(f"Map {chart_id} unchanged since last publish, skipping upload")
+            return publish_state.public_url(chart_id)
+        
+        # One metadata update, one data upload and one publish (title is NOT set - manage titles
+        # directly in Datawrapper); with PUBLISH_QUEUE=1 the queue worker makes them later
+        published_url = publish_queue.publish(chart_id, csv_content, metadata, current,
+                                              intro=description, as_of=format_date_ap_style(latest_date))
+        if not publish_queue.enabled():
+            logger.info(f"Map published successfully: {published_url}")
         return published_url
     
     except Exception as e:
@@ -497,6 +505,7 @@ def save_map_template(source_chart_id, template_file="map_template.json"):
     """
     Save the current visualization settings from a working map to a template file
     """
+    dw = get_datawrapper()
     try:
         # Get current chart settings
         current_chart = dw.get_chart(source_chart_id)
@@ -520,67 +529,32 @@ def save_map_template(source_chart_id, template_file="map_template.json"):
         logger.error(f"Error saving map template: {e}")
         raise
 
-def apply_map_template(chart_id, template_file="map_template.json", intro=None, tooltip_template=None):
-    """
-    Apply saved template settings to another map.
-    NOTE: Title is NOT set here - manage titles directly in Datawrapper.
-    """
+def publish_map_update(config_name, data, latest_date, template_file=None):
+    """Upload and publish a map's data, falling back to its last good payload if that fails"""
+    config = MAP_CONFIGS[config_name]
     try:
-        # Load template settings
-        if isinstance(template_file, dict):
-            # Template is already loaded as dict
-            template = template_file
-        else:
-            # Load template from file
-            with open(template_file, 'r') as f:
-                template = json.load(f)
-        
-        # Get current chart metadata
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
-        
-        # Create new metadata with template settings
-        metadata = {
-            "visualize": template.get('visualize', {}),
-            "mapping": template.get('mapping', {}),
-            "axes": template.get('axes', {})
-        }
-        
-        # Update describe section with current values (preserves existing title)
-        metadata["describe"] = current_metadata.get('describe', {})
-        
-        # Update intro/description if provided
-        if intro:
-            metadata["describe"]["intro"] = intro
-        
-        # Apply custom tooltip template if provided
-        if tooltip_template:
-            # Force create visualize.tooltip if it doesn't exist
-            if "tooltip" not in metadata["visualize"]:
-                metadata["visualize"]["tooltip"] = {}
-            
-            # Set the tooltip template with full HTML
-            metadata["visualize"]["tooltip"] = {
-                "body": tooltip_template,
-                "html": True,
-                "style": "custom",
-                "sticky": True,
-                "enabled": True
-            }
-            
-            logger.info(f"Applied custom tooltip template to chart {chart_id}")
-            
-        # Apply the settings (title is NOT set)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Applied template settings to chart {chart_id}")
-        
-        return True
-        
+        published_url = update_datawrapper_map(
+            chart_id=config["chart_id"],
+            data=data,
+            config=config,
+            latest_date=latest_date,
+            template=template_file
+        )
+        logger.info(f"Successfully updated {config_name} map: {published_url}")
+        return published_url
+    
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
+        raise
     except Exception as e:
-        logger.error(f"Error applying map template: {e}")
+        import traceback
+        logger.error(f"Failed to update {config_name} map: {e}")
+        logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
         raise
 
-def process_and_update_map(config_name, template_file=None):
+def process_and_update_map(config_name, template_file=None, publisher=None):
     """Process data and update a specific map"""
     config = MAP_CONFIGS[config_name]
     if not config["chart_id"]:
@@ -593,57 +567,33 @@ def process_and_update_map(config_name, template_file=None):
         
         # Log data columns to help debug
         logger.info(f"{config_name} data columns: {data.columns.tolist()}")
-        logger.info(f"{config_name} has {len(data)} records")
+        logger.info(f"{config_name} has {len(data)} records ({incident_total(data)} incidents)")
         
         if len(data) == 0:
-            logger.warning(f"No data available for {config_name}, skipping update")
+            logger.warning(f"No data available for {config_name}, serving last good payload")
+            last_good.serve_stale(config_name, config["chart_id"])
             return
         
-        # Update map
-        published_url = update_datawrapper_map(
-            chart_id=config["chart_id"],
-            data=data,
-            config=config,
-            latest_date=latest_date
-        )
-        
-        # Apply template settings if provided and this chart has a chart_id
-        if template_file and config["chart_id"]:
-            # Calculate the date range for display in AP Style
-            start_date = latest_date - timedelta(days=7)
-            query_date_range_ap = format_date_range_ap_style(start_date, latest_date)
-            
-            # Build description
-            description = config.get('description_template', f"Showing {{count}} incidents from {{date_range}}.").format(
-                count=f"{len(data):,}",
-                date_range=query_date_range_ap
-            ) if 'description_template' in config else f"Showing {len(data):,} incidents from {query_date_range_ap}."
-            
-            # Get the specific tooltip template for this map
-            tooltip_template = config.get('tooltip_template')
-            
-            # Log the tooltip template being used
-            logger.info(f"Applying tooltip template for {config_name}: {tooltip_template[:50]}...")
-            
-            # Apply template with the map-specific tooltip (title is NOT set)
-            apply_map_template(
-                chart_id=config["chart_id"],
-                template_file=template_file,
-                intro=description,
-                tooltip_template=tooltip_template
-            )
-        
-        logger.info(f"Successfully updated {config_name} map: {published_url}")
+        # Upload and publish on the publisher's threads, so this map renders while the next one is fetched
+        publisher = publisher or Publisher(workers=1)
+        publisher.submit(config["chart_id"], publish_map_update, config_name, data, latest_date, template_file)
     
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
     except Exception as e:
         import traceback
         logger.error(f"Failed to update {config_name} map: {e}")
         logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
 
 def update_all_maps():
     """Update all configured maps with chart IDs"""
     logger.info("Starting scheduled update of all 911 incident maps")
     
+    # Transform workers start before any fetch or publish threads do
+    start_pool()
+    
     # First, check if we have a source template to use
     template = None
     template_file = "911_map_template.json"
@@ -663,12 +613,20 @@ def update_all_maps():
                     logger.warning(f"Could not save template from {map_name}: {e}")
     
     # Then update all maps with valid chart IDs
-    for map_name in MAP_CONFIGS:
+    def update_map(map_name, publisher=None):
         if MAP_CONFIGS[map_name]["chart_id"]:
-            process_and_update_map(map_name, template)
+            process_and_update_map(map_name, template, publisher)
         else:
             logger.warning(f"Skipping {map_name} - no chart ID configured")
     
+    # Publish several maps at once
+    with Publisher() as publisher:
+        run_configs(MAP_CONFIGS, lambda map_name: update_map(map_name, publisher))
+    
+    # Retry maps that fell back to their last good payload (publishing inline)
+    last_good.revalidate(update_map)
+    
+    log_summary(logger)
     logger.info("Completed update of all maps with valid chart IDs")
 
 if __name__ == "__main__":
@@ -2,13 +2,18 @@
 # DataSF to Datawrapper Automation Pipeline - 911 Call Data
 # For San Francisco Examiner
 
-import os
 import pandas as pd
-from sodapy import Socrata
-import datawrapper
 import logging
 from datetime import datetime, timedelta
 
+from ap_style import format_date_ap_style
+from circuit_breaker import CircuitOpenError, log_summary
+from clients import run_per_domain, socrata_for
+from month_year_matrix import pivot_month_year
+import publish_queue
+import publish_state
+from publisher import Publisher
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -21,31 +26,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style.
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
-
-# API Credentials
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DATASF_APP_TOKEN = os.environ.get("DATASF_APP_TOKEN", "xdboBmIBQtjISZqIRYDWjKyxY")
-
-# Initialize API clients
-dw = datawrapper.Datawrapper(access_token=DATAWRAPPER_API_KEY)
-client = Socrata("data.sfgov.org", DATASF_APP_TOKEN)
-
 # Configuration for 911 charts
+# Each config may set "domain" to query another Socrata portal (default data.sfgov.org)
+# plus "source_name"/"source_url" to credit it; different domains are updated concurrently.
 CHART_CONFIGS = {
     "violent_crimes_monthly_comparison": {
         "dataset_id": "wg3w-h783",  # Police Department Incident Reports 2018 to Present
@@ -91,7 +74,7 @@ CHART_CONFIGS = {
 
 def get_data_from_datasf(chart_config):
     """Fetch data from DataSF API based on chart configuration."""
-    client = Socrata("data.sfgov.org", app_token=DATASF_APP_TOKEN)
+    client = socrata_for(chart_config)
     
     # First, find the latest date in the dataset
     latest_date_query = f"SELECT MAX(incident_date) as latest_date FROM {chart_config['dataset_id']}"
@@ -136,26 +119,8 @@ def get_data_from_datasf(chart_config):
             # Log raw data for debugging
             logging.info(f"Raw data before pivoting:\n{df.head()}")
             
-            # Convert month numbers to month names
-            month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-            df['month'] = df['month'].astype(int).map(lambda x: month_names[x-1])
-            
-            # Ensure proper ordering of months
-            df['month'] = pd.Categorical(df['month'], categories=month_names, ordered=True)
-            
-            # Pivot the data to create columns for each year
-            df_pivot = df.pivot(index='month', columns='year', values='count')
-            
-            # Ensure all months are present in correct order
-            df_pivot = df_pivot.reindex(month_names)
-            
-            # Reset index to make month a column again
-            df_pivot.reset_index(inplace=True)
-            df = df_pivot
-            
-            # Ensure year columns are in order
-            year_cols = [col for col in df.columns if col != 'month']
-            df = df[['month'] + sorted(year_cols)]
+            # Scatter (year, month, count) into a month-by-year table
+            df = pivot_month_year(df, 'count')
             
         logging.info(f"Retrieved {len(df)} records from DataSF")
         if not df.empty:
@@ -172,9 +137,6 @@ def update_datawrapper_chart(chart_id, data, config):
     try:
         logger.info(f"Updating Datawrapper chart {chart_id}")
         
-        # Update data
-        dw.add_data(chart_id, data)
-        
         # Get the years from the data columns (excluding 'month' column)
         years = sorted([str(col) for col in data.columns if col != 'month'])
         
@@ -214,8 +176,8 @@ def update_datawrapper_chart(chart_id, data, config):
         current_date_ap = format_date_ap_style(datetime.now())
         metadata = {
             "describe": {
-                "source-name": "DataSF - Police Department Incident Reports",
-                "source-url": "https://data.sfgov.org/Public-Safety/Police-Department-Incident-Reports-2018-to-Present/wg3w-h783",
+                "source-name": config.get("source_name", "DataSF - Police Department Incident Reports"),
+                "source-url": config.get("source_url", "https://data.sfgov.org/Public-Safety/Police-Department-Incident-Reports-2018-to-Present/wg3w-h783"),
                 "intro": "",
                 "byline": "San Francisco Examiner"
                 # NOTE: Title is NOT set here - manage titles directly in Datawrapper
@@ -251,25 +213,46 @@ def update_datawrapper_chart(chart_id, data, config):
             }
         }
         
-        # Update chart (title is NOT set - manage titles directly in Datawrapper)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Updated chart metadata for {chart_id}")
-        
-        # Publish chart
-        dw.publish_chart(chart_id)
+        # Leave the chart alone if neither the data nor the metadata changed since the last publish
+        current = publish_state.fingerprint(data, metadata)
+        if publish_state.unchanged(chart_id, current):
+            logger.info(f"Chart {chart_id} unchanged since last publish, skipping upload")
+            return publish_state.public_url(chart_id)
         
-        # Get the published URL using the newer get_chart method
-        chart_info = dw.get_chart(chart_id)
-        published_url = chart_info.get("publicUrl", "Unknown URL")
-        
-        logger.info(f"Chart published successfully: {published_url}")
+        # Data, metadata and publish (title is NOT set - manage titles directly in Datawrapper);
+        # with PUBLISH_QUEUE=1 the queue worker makes them later
+        published_url = publish_queue.publish(chart_id, data, metadata, current)
+        if not publish_queue.enabled():
+            logger.info(f"Chart published successfully: {published_url}")
         return published_url
     
     except Exception as e:
         logger.error(f"Error updating Datawrapper chart: {e}")
         raise
 
-def process_and_update_chart(config_name):
+def publish_chart_update(config_name, data):
+    """Upload and publish a chart's data"""
+    config = CHART_CONFIGS[config_name]
+    try:
+        # Update chart
+        published_url = update_datawrapper_chart(
+            chart_id=config["chart_id"],
+            data=data,
+            config=config
+        )
+        logger.info(f"Successfully updated {config_name} chart")
+        return published_url
+    
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} chart: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Failed to update {config_name} chart: {e}")
+        import traceback
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise
+
+def process_and_update_chart(config_name, publisher=None):
     """Process data and update a specific chart"""
     config = CHART_CONFIGS[config_name]
     if not config["chart_id"]:
@@ -280,14 +263,12 @@ def process_and_update_chart(config_name):
         # Get data
         data = get_data_from_datasf(config)
         
-        # Update chart
-        update_datawrapper_chart(
-            chart_id=config["chart_id"],
-            data=data,
-            config=config
-        )
-        logger.info(f"Successfully updated {config_name} chart")
+        # Upload and publish on the publisher's threads, so this chart renders while the next one is fetched
+        publisher = publisher or Publisher(workers=1)
+        publisher.submit(config["chart_id"], publish_chart_update, config_name, data)
     
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} chart: {e}")
     except Exception as e:
         logger.error(f"Failed to update {config_name} chart: {e}")
         import traceback
@@ -296,8 +277,9 @@ def process_and_update_chart(config_name):
 def update_all_charts():
     """Update all configured charts"""
     logger.info("Starting scheduled update of all 911 charts")
-    for chart_name in CHART_CONFIGS:
-        process_and_update_chart(chart_name)
+    with Publisher() as publisher:
+        run_per_domain(CHART_CONFIGS, lambda config_name: process_and_update_chart(config_name, publisher))
+    log_summary(logger)
     logger.info("Completed update of all 911 charts")
 
 if __name__ == "__main__":
@@ -2,16 +2,29 @@
 # DataSF to Datawrapper Automation Pipeline - Building Permits Maps
 # For San Francisco Examiner
 
-import os
 import pandas as pd
-from sodapy import Socrata
-import datawrapper
 import logging
 from datetime import datetime, timedelta
-import requests
+import copy
 import json
 import re
 
+from addresses import join_address_parts, normalize_street_address
+from ap_style import ap_datetime_column, format_date_ap_style, format_date_range_ap_style
+from circuit_breaker import CircuitOpenError, log_summary
+from clients import fetch_lock, get_datawrapper, socrata_for
+from column_spec import NOT_AVAILABLE, ColumnSpec, build_frame, csv_bytes, datawrapper_frame, empty_frame
+from coordinates import point_coordinates
+from dtype_plan import CATEGORY, COORDINATE, TEXT
+import last_good
+from map_publish import load_template
+import publish_queue
+import publish_state
+from publisher import Publisher
+from transform_pool import run_configs, run_transform, start_pool
+from unique_transform import per_unique, title_case
+from validation import coordinate_checks, map_bounds, quarantine_invalid, range_check, timestamp_check
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,49 +36,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Inserts a thousands separator before every group of three trailing digits
+THOUSANDS_RE = r'\B(?=(\d{3})+(?!\d))'
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style.
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
 
+def parse_estimated_cost(values):
+    """Parse estimated_cost into a float column; anything non-numeric becomes NaN."""
+    return pd.to_numeric(values, errors='coerce')
 
-def format_date_range_ap_style(start_dt, end_dt):
+
+def format_estimated_cost(costs):
     """
-    Format a date range in AP Style.
-    - If same month: "Jan. 15-21, 2025"
-    - If different months: "Jan. 28 - Feb. 3, 2025"
+    Format a numeric cost column for the CSV, in bulk.
+    - Whole dollars with thousands separators: "1,250,000"
+    - Missing or unparseable costs: "Unknown"
     """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    
-    if start_dt.month == end_dt.month and start_dt.year == end_dt.year:
-        return f"{ap_months[start_dt.month]} {start_dt.day}-{end_dt.day}, {end_dt.year}"
-    else:
-        return f"{ap_months[start_dt.month]} {start_dt.day} - {ap_months[end_dt.month]} {end_dt.day}, {end_dt.year}"
+    formatted = pd.Series('Unknown', index=costs.index, dtype=object)
+    known = costs.notna()
+    if known.any():
+        whole = costs[known].round().astype('int64').astype(str)
+        formatted[known] = whole.str.replace(THOUSANDS_RE, ',', regex=True)
+    return formatted
+
+
+def permit_address(df):
+    """Street address built from the number, name and suffix parts"""
+    return normalize_street_address(join_address_parts(df, ['street_number', 'street_name', 'street_suffix']))
 
-# API Credentials
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DATASF_APP_TOKEN = os.environ.get("DATASF_APP_TOKEN", "xdboBmIBQtjISZqIRYDWjKyxY")
 
-# Initialize API clients
-dw = datawrapper.Datawrapper(access_token=DATAWRAPPER_API_KEY)
-client = Socrata("data.sfgov.org", DATASF_APP_TOKEN)
+# Output columns of the map frame and the Datawrapper CSV (see column_spec.py)
+MAP_COLUMNS = [
+    ColumnSpec('lat', dtype=COORDINATE, csv_name='latitude'),
+    ColumnSpec('long', dtype=COORDINATE, csv_name='longitude'),
+    ColumnSpec('status', missing=NOT_AVAILABLE, fill='Unknown', dtype=CATEGORY),
+    ColumnSpec('address', derive=permit_address, dtype=TEXT),
+    ColumnSpec('issued_datetime', dtype=TEXT),
+    ColumnSpec('completed_datetime', dtype=TEXT),
+    ColumnSpec('neighborhood', source='neighborhoods_analysis_boundaries', missing=NOT_AVAILABLE, fill='N/A',
+               clean=per_unique(title_case), dtype=CATEGORY),
+    ColumnSpec('district', source='supervisor_district', missing=NOT_AVAILABLE, fill='N/A', dtype=CATEGORY),
+    ColumnSpec('permit_type_definition', missing=NOT_AVAILABLE, fill='Unknown', dtype=CATEGORY),
+    # Kept numeric in the frame; formatted as currency only in the CSV
+    ColumnSpec('estimated_cost', missing=NOT_AVAILABLE, fill='0', clean=parse_estimated_cost,
+               serialize=format_estimated_cost),
+    ColumnSpec('description', missing=NOT_AVAILABLE, fill='No description available', dtype=TEXT),
+]
 
 # Configuration for Building Permits maps
+# Each config may set "domain" to query another Socrata portal (default data.sfgov.org)
+# plus "source_name"/"source_url" to credit it; different domains are updated concurrently.
 MAP_CONFIGS = {
     "permits_issued_map": {
         "dataset_id": "i98e-djp9",  # Building Permits dataset
@@ -105,8 +124,16 @@ MAP_CONFIGS = {
     }
 }
 
-def get_map_data_from_datasf(chart_config):
-    """Fetch building permit location data from DataSF API for the most recent complete month."""
+def map_contract(chart_config):
+    """Checks every fetched row must pass before it is mapped (see validation.py)"""
+    return coordinate_checks('lat', 'long', map_bounds(chart_config)) + [
+        timestamp_check(chart_config['date_field']),
+        range_check('supervisor_district', 1, 11),
+    ]
+
+def fetch_map_records(chart_config):
+    """Fetch the raw building permit rows for the most recent complete month from DataSF."""
+    client = socrata_for(chart_config)
     
     # First, find the latest date in the dataset for the specific date field
     date_field = chart_config['date_field']
@@ -217,115 +244,69 @@ def get_map_data_from_datasf(chart_config):
                 
             offset += limit
             
+        except CircuitOpenError:
+            # Never publish a partial page set because the host went down mid-fetch
+            raise
         except Exception as e:
             logging.error(f"Error fetching data from DataSF at offset {offset}: {str(e)}")
             break
     
     df = pd.DataFrame.from_records(all_results)
-    
-    # Initialize final_df as empty DataFrame with required columns
-    required_cols = [
-        'lat', 'long', 'status', 'address', 'issued_datetime', 'completed_datetime',
-        'neighborhood', 'district', 'permit_type_definition', 'estimated_cost', 'description'
-    ]
-    final_df = pd.DataFrame(columns=required_cols)
+    del all_results  # the frame holds the rows now; free the per-row dicts before the transform
+    return df, end_date
+
+def transform_map_data(df, chart_config):
+    """Turn the raw DataSF rows into the publish-ready map frame."""
+    date_field = chart_config['date_field']
+    final_df = empty_frame(MAP_COLUMNS)
     
     if not df.empty:
         # Extract latitude and longitude from location field
         if 'location' in df.columns:
-            # Parse the location JSON field
-            df['lat'] = df['location'].apply(lambda x: x['coordinates'][1] if isinstance(x, dict) and 'coordinates' in x else None)
-            df['long'] = df['location'].apply(lambda x: x['coordinates'][0] if isinstance(x, dict) and 'coordinates' in x else None)
+            # Parse the location JSON field in a single pass
+            df['lat'], df['long'] = point_coordinates(df['location'])
         else:
             df['lat'] = None
             df['long'] = None
         
+        # Rows with bad coordinates or timestamps go to the quarantine file instead of the map
+        df = quarantine_invalid(df, map_contract(chart_config), chart_config['chart_id'])
+        
         # Convert datetime
         if date_field in df.columns:
             df[date_field] = pd.to_datetime(df[date_field])
         
-        # Create formatted datetime fields
+        # Create AP Style datetime fields
         if date_field == 'issued_date':
-            df['issued_datetime'] = df[date_field].dt.strftime('%B %d, %Y %I:%M %p')
+            df['issued_datetime'] = ap_datetime_column(df[date_field])
             df['completed_datetime'] = 'Not completed'
         else:  # completed_date
-            df['completed_datetime'] = df[date_field].dt.strftime('%B %d, %Y %I:%M %p')
+            df['completed_datetime'] = ap_datetime_column(df[date_field])
             df['issued_datetime'] = 'N/A'
         
         # Handle potential missing columns and values
         logging.info(f"Actual columns in response: {df.columns.tolist()}")
         
-        # Add missing columns with default values if they don't exist
-        required_columns = [
-            'neighborhoods_analysis_boundaries', 'supervisor_district', 
-            'permit_type_definition', 'estimated_cost', 'status',
-            'street_number', 'street_name', 'street_suffix', 'description'
-        ]
-        
-        for col in required_columns:
-            if col not in df.columns:
-                logging.warning(f"Column '{col}' not found in response, adding with default values")
-                df[col] = 'Not Available'
-        
-        # Fill missing values in existing columns
-        df['neighborhoods_analysis_boundaries'] = df['neighborhoods_analysis_boundaries'].fillna('N/A')
-        df['supervisor_district'] = df['supervisor_district'].fillna('N/A')
-        df['permit_type_definition'] = df['permit_type_definition'].fillna('Unknown')
-        df['estimated_cost'] = df['estimated_cost'].fillna('0')
-        df['status'] = df['status'].fillna('Unknown')
-        df['description'] = df['description'].fillna('No description available')
-        
-        # Format estimated cost as currency
-        df['estimated_cost'] = df['estimated_cost'].apply(
-            lambda x: f"{float(x):,.0f}" if str(x).replace('.', '').isdigit() else "Unknown"
-        )
-        
-        # Create address from street components
-        def create_address(row):
-            parts = []
-            if pd.notna(row['street_number']) and row['street_number'] != 'Not Available':
-                parts.append(str(row['street_number']))
-            if pd.notna(row['street_name']) and row['street_name'] != 'Not Available':
-                parts.append(str(row['street_name']))
-            if pd.notna(row['street_suffix']) and row['street_suffix'] != 'Not Available':
-                parts.append(str(row['street_suffix']))
-            return ' '.join(parts) if parts else 'Address Unknown'
-        
-        df['address'] = df.apply(create_address, axis=1)
-        
-        # Format neighborhood with title case
-        df['neighborhoods_analysis_boundaries'] = df['neighborhoods_analysis_boundaries'].apply(
-            lambda x: x.title() if isinstance(x, str) else x
-        )
-        
-        # Create final DataFrame with specific columns
-        final_df = pd.DataFrame({
-            'lat': pd.to_numeric(df['lat'], errors='coerce'),
-            'long': pd.to_numeric(df['long'], errors='coerce'),
-            'status': df['status'],
-            'address': df['address'],
-            'issued_datetime': df['issued_datetime'],
-            'completed_datetime': df['completed_datetime'],
-            'neighborhood': df['neighborhoods_analysis_boundaries'],
-            'district': df['supervisor_district'],
-            'permit_type_definition': df['permit_type_definition'],
-            'estimated_cost': df['estimated_cost'],
-            'description': df['description']
-        })
-        
-        # Drop any rows with invalid lat/long
-        final_df = final_df.dropna(subset=['lat', 'long'])
-        
-        # Ensure the DataFrame has the correct column order
-        final_df = final_df[required_cols]
+        # Missing columns, null fills, the street address and cost parsing are declared in MAP_COLUMNS
+        final_df = build_frame(df, MAP_COLUMNS)
         
         # Log the first few rows to verify format
         logging.info(f"Sample of final data:\n{final_df.head().to_string()}")
         
+    return final_df
+
+def get_map_data_from_datasf(chart_config):
+    """Fetch building permit location data from DataSF API for the most recent complete month."""
+    with fetch_lock(chart_config):
+        df, end_date = fetch_map_records(chart_config)
+    
+    # String-heavy cleanup; runs in a worker process when the transform pool is on
+    final_df = run_transform(transform_map_data, df, chart_config)
+    
     logging.info(f"Retrieved total of {len(final_df)} permits from DataSF")
     return final_df, end_date
 
-def update_datawrapper_map(chart_id, data, config, latest_date):
+def update_datawrapper_map(chart_id, data, config, latest_date, template=None):
     """Update a Datawrapper map with new building permit data"""
     try:
         logger.info(f"Updating Datawrapper map {chart_id}")
@@ -334,27 +315,16 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         if not all(col in data.columns for col in ['lat', 'long', 'status']):
             raise ValueError(f"Missing required columns. Found: {data.columns.tolist()}")
         
-        # Create a new DataFrame with Datawrapper's expected column names
-        dw_data = pd.DataFrame({
-            'latitude': pd.to_numeric(data['lat'], errors='coerce'),
-            'longitude': pd.to_numeric(data['long'], errors='coerce'),
-            'status': data['status'],
-            'address': data['address'],
-            'issued_datetime': data['issued_datetime'],
-            'completed_datetime': data['completed_datetime'],
-            'neighborhood': data['neighborhood'],
-            'district': data['district'],
-            'permit_type_definition': data['permit_type_definition'],
-            'estimated_cost': data['estimated_cost'],
-            'description': data['description']
-        })
-        
-        # Drop any rows with invalid lat/long
-        dw_data = dw_data.dropna(subset=['latitude', 'longitude'])
+        # Datawrapper's expected column names, without rows that have invalid lat/long
+        dw_data = datawrapper_frame(data, MAP_COLUMNS)
         
-        # FIRST: Fetch current chart metadata to preserve custom settings
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
+        # Settings come from this run's template snapshot (a private copy - every map shares it);
+        # without one, fetch the chart's own metadata to preserve its custom settings
+        template = load_template(template)
+        if template:
+            current_metadata = copy.deepcopy(template)
+        else:
+            current_metadata = get_datawrapper().get_chart(chart_id).get('metadata', {})
         
         # Get current visualization settings
         current_viz_settings = current_metadata.get('visualize', {})
@@ -374,8 +344,8 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         # NOTE: Title is NOT set here - manage titles directly in Datawrapper
         metadata = {
             "describe": {
-                "source-name": "DataSF - Building Permits",
-                "source-url": "https://data.sfgov.org/Housing-and-Buildings/Building-Permits/i98e-djp9",
+                "source-name": config.get("source_name", "DataSF - Building Permits"),
+                "source-url": config.get("source_url", "https://data.sfgov.org/Housing-and-Buildings/Building-Permits/i98e-djp9"),
                 "intro": description,
                 "byline": "San Francisco Examiner"
             },
@@ -447,35 +417,39 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
                 "color": "status"
             }
         
-        # Update chart (title is NOT set - manage titles directly in Datawrapper)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Updated map metadata for {chart_id} (preserving custom settings)")
-
-        # Update the data using direct API call with proper encoding
-        api_token = DATAWRAPPER_API_KEY
-        csv_content = dw_data.to_csv(index=False)
-        
-        response = requests.put(
-            f"https://api.datawrapper.de/v3/charts/{chart_id}/data",
-            headers={
-                "Authorization": f"Bearer {api_token}",
-                "Content-Type": "text/csv; charset=utf-8"
-            },
-            data=csv_content.encode('utf-8')
-        )
+        # The template's mapping and axes go out in the same metadata update
+        if template:
+            metadata["mapping"] = current_metadata.get('mapping') or metadata["mapping"]
+            metadata["axes"] = current_metadata.get('axes', {})
         
-        if response.status_code != 204:
-            logger.error(f"Error uploading data: {response.status_code} {response.text}")
-            raise Exception(f"Failed to upload data: {response.status_code}")
-        logger.info(f"Uploaded data columns for {chart_id} via API")
-
-        # Publish map
-        dw.publish_chart(chart_id)
-        
-        map_info = dw.get_chart(chart_id)
-        published_url = map_info.get("publicUrl", "Unknown URL")
-        
-        logger.info(f"Map published successfully: {published_url}")
+        # Apply custom tooltip template from config (overrides preserved settings)
+        tooltip_template = config.get('tooltip_template')
+        if tooltip_template:
+            if "visualize" not in metadata:
+                metadata["visualize"] = {}
+            metadata["visualize"]["tooltip"] = {
+                "title": "",  # Clear the title field - we include title in body HTML
+                "body": tooltip_template,
+                "html": True,
+                "style": "custom",
+                "sticky": True,
+                "enabled": True
+            }
+            logger.info(f"Applied custom tooltip template to {chart_id}")
+        
+        # Leave the map alone if neither the data nor the metadata changed since the last publish
+        csv_content = csv_bytes(dw_data)
+        current = publish_state.fingerprint(csv_content, metadata)
+        if publish_state.unchanged(chart_id, current):
+            logger.info(f"Map {chart_id} unchanged since last publish, skipping upload")
+            return publish_state.public_url(chart_id)
+        
+        # One metadata update, one data upload and one publish (title is NOT set - manage titles
+        # directly in Datawrapper); with PUBLISH_QUEUE=1 the queue worker makes them later
+        published_url = publish_queue.publish(chart_id, csv_content, metadata, current,
+                                              intro=description, as_of=format_date_ap_style(latest_date))
+        if not publish_queue.enabled():
+            logger.info(f"Map published successfully: {published_url}")
         return published_url
     
     except Exception as e:
@@ -486,6 +460,7 @@ def save_map_template(source_chart_id, template_file="building_permits_map_templ
     """
     Save the current visualization settings from a working map to a template file
     """
+    dw = get_datawrapper()
     try:
         # Get current chart settings
         current_chart = dw.get_chart(source_chart_id)
@@ -509,67 +484,32 @@ def save_map_template(source_chart_id, template_file="building_permits_map_templ
         logger.error(f"Error saving map template: {e}")
         raise
 
-def apply_map_template(chart_id, template_file="building_permits_map_template.json", intro=None, tooltip_template=None):
-    """
-    Apply saved template settings to another map.
-    NOTE: Title is NOT set here - manage titles directly in Datawrapper.
-    """
+def publish_map_update(config_name, data, latest_date, template_file=None):
+    """Upload and publish a map's data, falling back to its last good payload if that fails"""
+    config = MAP_CONFIGS[config_name]
     try:
-        # Load template settings
-        if isinstance(template_file, dict):
-            # Template is already loaded as dict
-            template = template_file
-        else:
-            # Load template from file
-            with open(template_file, 'r') as f:
-                template = json.load(f)
-        
-        # Get current chart metadata
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
-        
-        # Create new metadata with template settings
-        metadata = {
-            "visualize": template.get('visualize', {}),
-            "mapping": template.get('mapping', {}),
-            "axes": template.get('axes', {})
-        }
-        
-        # Update describe section with current values (preserves existing title)
-        metadata["describe"] = current_metadata.get('describe', {})
-        
-        # Update intro/description if provided
-        if intro:
-            metadata["describe"]["intro"] = intro
-        
-        # Apply custom tooltip template if provided
-        if tooltip_template:
-            # Force create visualize.tooltip if it doesn't exist
-            if "tooltip" not in metadata["visualize"]:
-                metadata["visualize"]["tooltip"] = {}
-            
-            # Set the tooltip template with full HTML
-            metadata["visualize"]["tooltip"] = {
-                "body": tooltip_template,
-                "html": True,
-                "style": "custom",
-                "sticky": True,
-                "enabled": True
-            }
-            
-            logger.info(f"Applied custom tooltip template to chart {chart_id}")
-            
-        # Apply the settings (title is NOT set)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Applied template settings to chart {chart_id}")
-        
-        return True
-        
+        published_url = update_datawrapper_map(
+            chart_id=config["chart_id"],
+            data=data,
+            config=config,
+            latest_date=latest_date,
+            template=template_file
+        )
+        logger.info(f"Successfully updated {config_name} map")
+        return published_url
+    
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
+        raise
     except Exception as e:
-        logger.error(f"Error applying map template: {e}")
+        import traceback
+        logger.error(f"Failed to update {config_name} map: {e}")
+        logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
         raise
 
-def process_and_update_map(config_name, template_file=None):
+def process_and_update_map(config_name, template_file=None, publisher=None):
     """Process data and update a specific map"""
     config = MAP_CONFIGS[config_name]
     if not config["chart_id"]:
@@ -585,54 +525,30 @@ def process_and_update_map(config_name, template_file=None):
         logger.info(f"{config_name} has {len(data)} records")
         
         if len(data) == 0:
-            logger.warning(f"No data available for {config_name}, skipping update")
+            logger.warning(f"No data available for {config_name}, serving last good payload")
+            last_good.serve_stale(config_name, config["chart_id"])
             return
         
-        # Update map
-        update_datawrapper_map(
-            chart_id=config["chart_id"],
-            data=data,
-            config=config,
-            latest_date=latest_date
-        )
-        
-        # Apply template settings if provided and this is not the source map
-        if template_file and config["chart_id"] != "2X0Uf":  # 2X0Uf is the source map
-            # Use AP Style date range for display
-            start_date = latest_date - timedelta(days=7)
-            query_date_range_ap = format_date_range_ap_style(start_date, latest_date)
-            
-            # Build description
-            description = config.get('description_template', f"Showing {{count}} permits from {{date_range}}.").format(
-                count=f"{len(data):,}",
-                date_range=query_date_range_ap
-            ) if 'description_template' in config else f"Showing {len(data):,} permits from {query_date_range_ap}."
-            
-            # Get the specific tooltip template for this map
-            tooltip_template = config.get('tooltip_template')
-            
-            # Log the tooltip template being used
-            logger.info(f"Applying tooltip template for {config_name}: {tooltip_template[:50]}...")
-            
-            # Apply template with the map-specific tooltip (title is NOT set)
-            apply_map_template(
-                chart_id=config["chart_id"],
-                template_file=template_file,
-                intro=description,
-                tooltip_template=tooltip_template
-            )
-        
-        logger.info(f"Successfully updated {config_name} map")
+        # Upload and publish on the publisher's threads, so this map renders while the next one is fetched
+        publisher = publisher or Publisher(workers=1)
+        publisher.submit(config["chart_id"], publish_map_update, config_name, data, latest_date, template_file)
     
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
     except Exception as e:
         import traceback
         logger.error(f"Failed to update {config_name} map: {e}")
         logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
 
 def update_all_maps():
     """Update all configured maps"""
     logger.info("Starting scheduled update of all building permits maps")
     
+    # Transform workers start before any fetch or publish threads do
+    start_pool()
+    
     # First, save template from the first working map (when configured)
     template = None
     template_file = "building_permits_map_template.json"
@@ -652,12 +568,20 @@ def update_all_maps():
                     logger.warning(f"Could not save template from {map_name}: {e}")
     
     # Then update all maps with valid chart IDs
-    for map_name in MAP_CONFIGS:
+    def update_map(map_name, publisher=None):
         if MAP_CONFIGS[map_name]["chart_id"]:
-            process_and_update_map(map_name, template)
+            process_and_update_map(map_name, template, publisher)
         else:
             logger.warning(f"Skipping {map_name} - no chart ID configured")
     
+    # Publish several maps at once
+    with Publisher() as publisher:
+        run_configs(MAP_CONFIGS, lambda map_name: update_map(map_name, publisher))
+    
+    # Retry maps that fell back to their last good payload (publishing inline)
+    last_good.revalidate(update_map)
+    
+    log_summary(logger)
     logger.info("Completed update of all building permits maps")
 
 if __name__ == "__main__":
@@ -2,16 +2,29 @@
 # DataSF to Datawrapper Automation Pipeline - Business Openings Maps
 # For San Francisco Examiner
 
-import os
 import pandas as pd
-from sodapy import Socrata
-import datawrapper
 import logging
 from datetime import datetime, timedelta
-import requests
+import copy
 import json
 import re
 
+from ap_style import ap_date_column, format_date_ap_style, format_date_range_ap_style
+from business_activity import classify_business_activity
+from circuit_breaker import CircuitOpenError, log_summary
+from clients import fetch_lock, get_datawrapper, socrata_for
+from column_spec import NOT_AVAILABLE, ColumnSpec, build_frame, csv_bytes, datawrapper_frame, empty_frame
+from coordinates import point_coordinates
+from dtype_plan import CATEGORY, COORDINATE, TEXT
+import last_good
+from map_publish import load_template
+import publish_queue
+import publish_state
+from publisher import Publisher
+from transform_pool import run_configs, run_transform, start_pool
+from unique_transform import per_unique, title_case
+from validation import coordinate_checks, map_bounds, quarantine_invalid, range_check, timestamp_check
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,48 +37,23 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style.
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
-
-
-def format_date_range_ap_style(start_dt, end_dt):
-    """
-    Format a date range in AP Style.
-    - If same month: "Jan. 15-21, 2025"
-    - If different months: "Jan. 28 - Feb. 3, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    
-    if start_dt.month == end_dt.month and start_dt.year == end_dt.year:
-        return f"{ap_months[start_dt.month]} {start_dt.day}-{end_dt.day}, {end_dt.year}"
-    else:
-        return f"{ap_months[start_dt.month]} {start_dt.day} - {ap_months[end_dt.month]} {end_dt.day}, {end_dt.year}"
-
-# API Credentials
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DATASF_APP_TOKEN = os.environ.get("DATASF_APP_TOKEN", "xdboBmIBQtjISZqIRYDWjKyxY")
-
-# Initialize API clients
-dw = datawrapper.Datawrapper(access_token=DATAWRAPPER_API_KEY)
-client = Socrata("data.sfgov.org", DATASF_APP_TOKEN)
+# Output columns of the map frame and the Datawrapper CSV (see column_spec.py)
+MAP_COLUMNS = [
+    ColumnSpec('lat', dtype=COORDINATE, csv_name='latitude'),
+    ColumnSpec('long', dtype=COORDINATE, csv_name='longitude'),
+    ColumnSpec('dba_name', missing=NOT_AVAILABLE, fill='Unknown Business', dtype=TEXT),
+    ColumnSpec('address', source='full_business_address', missing=NOT_AVAILABLE, fill='Address Unknown', dtype=TEXT),
+    ColumnSpec('opened_datetime', dtype=TEXT),
+    ColumnSpec('neighborhood', source='neighborhoods_analysis_boundaries', missing=NOT_AVAILABLE, fill='N/A',
+               clean=per_unique(title_case), dtype=CATEGORY),
+    ColumnSpec('district', source='supervisor_district', missing=NOT_AVAILABLE, fill='N/A', dtype=CATEGORY),
+    ColumnSpec('business_type', source='naic_code_description', missing=NOT_AVAILABLE, fill='Unknown', dtype=CATEGORY),
+    ColumnSpec('activity_type', dtype=CATEGORY),
+]
 
 # Configuration for Business Openings maps
+# Each config may set "domain" to query another Socrata portal (default data.sfgov.org)
+# plus "source_name"/"source_url" to credit it; different domains are updated concurrently.
 MAP_CONFIGS = {
     "business_openings_map": {
         "dataset_id": "g8m3-pdis",  # Registered Business Locations dataset
@@ -86,8 +74,17 @@ MAP_CONFIGS = {
     }
 }
 
-def get_map_data_from_datasf(chart_config):
-    """Fetch business opening location data from DataSF API for the last 7 days."""
+def map_contract(chart_config):
+    """Checks every fetched row must pass before it is mapped (see validation.py)"""
+    return coordinate_checks('lat', 'long', map_bounds(chart_config)) + [
+        timestamp_check(chart_config['date_field']),
+        timestamp_check('dba_start_date', required=False),
+        range_check('supervisor_district', 1, 11),
+    ]
+
+def fetch_map_records(chart_config):
+    """Fetch the raw business opening rows for the last 7 days from DataSF."""
+    client = socrata_for(chart_config)
     
     # First, find the latest date in the dataset for the specific date field
     date_field = chart_config['date_field']
@@ -203,103 +200,72 @@ def get_map_data_from_datasf(chart_config):
                 
             offset += limit
             
+        except CircuitOpenError:
+            # Never publish a partial page set because the host went down mid-fetch
+            raise
         except Exception as e:
             logging.error(f"Error fetching data from DataSF at offset {offset}: {str(e)}")
             break
     
     df = pd.DataFrame.from_records(all_results)
-    
-    # Initialize final_df as empty DataFrame with required columns
-    required_cols = [
-        'lat', 'long', 'dba_name', 'address', 'opened_datetime',
-        'neighborhood', 'district', 'business_type', 'activity_type'
-    ]
-    final_df = pd.DataFrame(columns=required_cols)
+    del all_results  # the frame holds the rows now; free the per-row dicts before the transform
+    return df, end_date
+
+def transform_map_data(df, chart_config):
+    """Turn the raw DataSF rows into the publish-ready map frame."""
+    date_field = chart_config['date_field']
+    final_df = empty_frame(MAP_COLUMNS)
     
     if not df.empty:
         # Extract latitude and longitude from location field
         if 'location' in df.columns:
-            # Parse the location JSON field
-            df['lat'] = df['location'].apply(lambda x: x['coordinates'][1] if isinstance(x, dict) and 'coordinates' in x else None)
-            df['long'] = df['location'].apply(lambda x: x['coordinates'][0] if isinstance(x, dict) and 'coordinates' in x else None)
+            # Parse the location JSON field in a single pass
+            df['lat'], df['long'] = point_coordinates(df['location'])
         else:
             df['lat'] = None
             df['long'] = None
         
+        # Rows with bad coordinates or timestamps go to the quarantine file instead of the map
+        df = quarantine_invalid(df, map_contract(chart_config), chart_config['chart_id'])
+        
         # Convert datetime
         if date_field in df.columns:
             df[date_field] = pd.to_datetime(df[date_field])
         if 'dba_start_date' in df.columns:
             df['dba_start_date'] = pd.to_datetime(df['dba_start_date'])
         
-        # Create formatted datetime field
-        df['opened_datetime'] = df[date_field].dt.strftime('%B %d, %Y')
+        # Create AP Style date field
+        df['opened_datetime'] = ap_date_column(df[date_field])
         
         # Determine business activity type (new vs relocated)
-        def determine_activity_type(row):
-            if pd.isna(row['dba_start_date']) or pd.isna(row[date_field]):
-                return 'Unknown'
-            elif row['dba_start_date'].date() == row[date_field].date():
-                return 'New Business'
-            elif row['dba_start_date'] < row[date_field]:
-                return 'Business Relocation'
-            else:
-                return 'Unknown'
-        
-        df['activity_type'] = df.apply(determine_activity_type, axis=1)
+        if 'dba_start_date' in df.columns:
+            df['activity_type'] = classify_business_activity(df[date_field], df['dba_start_date'])
+        else:
+            df['activity_type'] = 'Unknown'
         
         # Handle potential missing columns and values
         logging.info(f"Actual columns in response: {df.columns.tolist()}")
         
-        # Add missing columns with default values if they don't exist
-        required_columns = [
-            'neighborhoods_analysis_boundaries', 'supervisor_district', 
-            'naic_code_description', 'dba_name', 'full_business_address'
-        ]
-        
-        for col in required_columns:
-            if col not in df.columns:
-                logging.warning(f"Column '{col}' not found in response, adding with default values")
-                df[col] = 'Not Available'
-        
-        # Fill missing values in existing columns
-        df['neighborhoods_analysis_boundaries'] = df['neighborhoods_analysis_boundaries'].fillna('N/A')
-        df['supervisor_district'] = df['supervisor_district'].fillna('N/A')
-        df['naic_code_description'] = df['naic_code_description'].fillna('Unknown')
-        df['dba_name'] = df['dba_name'].fillna('Unknown Business')
-        df['full_business_address'] = df['full_business_address'].fillna('Address Unknown')
-        
-        # Format neighborhood with title case
-        df['neighborhoods_analysis_boundaries'] = df['neighborhoods_analysis_boundaries'].apply(
-            lambda x: x.title() if isinstance(x, str) else x
-        )
-        
-        # Create final DataFrame with specific columns
-        final_df = pd.DataFrame({
-            'lat': pd.to_numeric(df['lat'], errors='coerce'),
-            'long': pd.to_numeric(df['long'], errors='coerce'),
-            'dba_name': df['dba_name'],
-            'address': df['full_business_address'],
-            'opened_datetime': df['opened_datetime'],
-            'neighborhood': df['neighborhoods_analysis_boundaries'],
-            'district': df['supervisor_district'],
-            'business_type': df['naic_code_description'],
-            'activity_type': df['activity_type']
-        })
-        
-        # Drop any rows with invalid lat/long
-        final_df = final_df.dropna(subset=['lat', 'long'])
-        
-        # Ensure the DataFrame has the correct column order
-        final_df = final_df[required_cols]
+        # Missing columns, null fills and text cleanup are declared in MAP_COLUMNS
+        final_df = build_frame(df, MAP_COLUMNS)
         
         # Log the first few rows to verify format
         logging.info(f"Sample of final data:\n{final_df.head().to_string()}")
         
+    return final_df
+
+def get_map_data_from_datasf(chart_config):
+    """Fetch business opening location data from DataSF API for the last 7 days."""
+    with fetch_lock(chart_config):
+        df, end_date = fetch_map_records(chart_config)
+    
+    # String-heavy cleanup; runs in a worker process when the transform pool is on
+    final_df = run_transform(transform_map_data, df, chart_config)
+    
     logging.info(f"Retrieved total of {len(final_df)} business openings from DataSF")
     return final_df, end_date
 
-def update_datawrapper_map(chart_id, data, config, latest_date):
+def update_datawrapper_map(chart_id, data, config, latest_date, template=None):
     """Update a Datawrapper map with new business opening data"""
     try:
         logger.info(f"Updating Datawrapper map {chart_id}")
@@ -308,25 +274,16 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         if not all(col in data.columns for col in ['lat', 'long']):
             raise ValueError(f"Missing required columns. Found: {data.columns.tolist()}")
         
-        # Create a new DataFrame with Datawrapper's expected column names
-        dw_data = pd.DataFrame({
-            'latitude': pd.to_numeric(data['lat'], errors='coerce'),
-            'longitude': pd.to_numeric(data['long'], errors='coerce'),
-            'dba_name': data['dba_name'],
-            'address': data['address'],
-            'opened_datetime': data['opened_datetime'],
-            'neighborhood': data['neighborhood'],
-            'district': data['district'],
-            'business_type': data['business_type'],
-            'activity_type': data['activity_type']
-        })
+        # Datawrapper's expected column names, without rows that have invalid lat/long
+        dw_data = datawrapper_frame(data, MAP_COLUMNS)
         
-        # Drop any rows with invalid lat/long
-        dw_data = dw_data.dropna(subset=['latitude', 'longitude'])
-        
-        # FIRST: Fetch current chart metadata to preserve custom settings
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
+        # Settings come from this run's template snapshot (a private copy - every map shares it);
+        # without one, fetch the chart's own metadata to preserve its custom settings
+        template = load_template(template)
+        if template:
+            current_metadata = copy.deepcopy(template)
+        else:
+            current_metadata = get_datawrapper().get_chart(chart_id).get('metadata', {})
         
         # Get current visualization settings
         current_viz_settings = current_metadata.get('visualize', {})
@@ -346,8 +303,8 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
         # NOTE: Title is NOT set here - manage titles directly in Datawrapper
         metadata = {
             "describe": {
-                "source-name": "DataSF - Registered Business Locations",
-                "source-url": "https://data.sfgov.org/Economy-and-Community/Registered-Business-Locations-San-Francisco/g8m3-pdis",
+                "source-name": config.get("source_name", "DataSF - Registered Business Locations"),
+                "source-url": config.get("source_url", "https://data.sfgov.org/Economy-and-Community/Registered-Business-Locations-San-Francisco/g8m3-pdis"),
                 "intro": description,
                 "byline": "San Francisco Examiner"
             },
@@ -418,35 +375,39 @@ def update_datawrapper_map(chart_id, data, config, latest_date):
                 "color": "activity_type"
             }
         
-        # Update the chart metadata (title is NOT set - manage in Datawrapper)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Updated map metadata for {chart_id} (preserving custom settings)")
-
-        # Update the data using direct API call with proper encoding
-        api_token = DATAWRAPPER_API_KEY
-        csv_content = dw_data.to_csv(index=False)
-        
-        response = requests.put(
-            f"https://api.datawrapper.de/v3/charts/{chart_id}/data",
-            headers={
-                "Authorization": f"Bearer {api_token}",
-                "Content-Type": "text/csv; charset=utf-8"
-            },
-            data=csv_content.encode('utf-8')
-        )
-        
-        if response.status_code != 204:
-            logger.error(f"Error uploading data: {response.status_code} {response.text}")
-            raise Exception(f"Failed to upload data: {response.status_code}")
-        logger.info(f"Uploaded data columns for {chart_id} via API")
-
-        # Publish map
-        dw.publish_chart(chart_id)
-        
-        map_info = dw.get_chart(chart_id)
-        published_url = map_info.get("publicUrl", "Unknown URL")
+        # The template's mapping and axes go out in the same metadata update
+        if template:
+            metadata["mapping"] = current_metadata.get('mapping') or metadata["mapping"]
+            metadata["axes"] = current_metadata.get('axes', {})
         
-        logger.info(f"Map published successfully: {published_url}")
+        # Apply custom tooltip template from config (overrides preserved settings)
+        tooltip_template = config.get('tooltip_template')
+        if tooltip_template:
+            if "visualize" not in metadata:
+                metadata["visualize"] = {}
+            metadata["visualize"]["tooltip"] = {
+                "title": "",  # Clear the title field - we include title in body HTML
+                "body": tooltip_template,
+                "html": True,
+                "style": "custom",
+                "sticky": True,
+                "enabled": True
+            }
+            logger.info(f"Applied custom tooltip template to {chart_id}")
+        
+        # Leave the map alone if neither the data nor the metadata changed since the last publish
+        csv_content = csv_bytes(dw_data)
+        current = publish_state.fingerprint(csv_content, metadata)
+        if publish_state.unchanged(chart_id, current):
+            logger.info(f"Map {chart_id} unchanged since last publish, skipping upload")
+            return publish_state.public_url(chart_id)
+        
+        # One metadata update, one data upload and one publish (title is NOT set - manage titles
+        # directly in Datawrapper); with PUBLISH_QUEUE=1 the queue worker makes them later
+        published_url = publish_queue.publish(chart_id, csv_content, metadata, current,
+                                              intro=description, as_of=format_date_ap_style(latest_date))
+        if not publish_queue.enabled():
+            logger.info(f"Map published successfully: {published_url}")
         return published_url
     
     except Exception as e:
@@ -457,6 +418,7 @@ def save_map_template(source_chart_id, template_file="business_openings_map_temp
     """
     Save the current visualization settings from a working map to a template file
     """
+    dw = get_datawrapper()
     try:
         # Get current chart settings
         current_chart = dw.get_chart(source_chart_id)
@@ -480,67 +442,32 @@ def save_map_template(source_chart_id, template_file="business_openings_map_temp
         logger.error(f"Error saving map template: {e}")
         raise
 
-def apply_map_template(chart_id, template_file="business_openings_map_template.json", intro=None, tooltip_template=None):
-    """
-    Apply saved template settings to another map.
-    NOTE: Title is NOT set here - manage titles directly in Datawrapper.
-    """
+def publish_map_update(config_name, data, latest_date, template_file=None):
+    """Upload and publish a map's data, falling back to its last good payload if that fails"""
+    config = MAP_CONFIGS[config_name]
     try:
-        # Load template settings
-        if isinstance(template_file, dict):
-            # Template is already loaded as dict
-            template = template_file
-        else:
-            # Load template from file
-            with open(template_file, 'r') as f:
-                template = json.load(f)
-        
-        # Get current chart metadata
-        current_chart = dw.get_chart(chart_id)
-        current_metadata = current_chart.get('metadata', {})
-        
-        # Create new metadata with template settings
-        metadata = {
-            "visualize": template.get('visualize', {}),
-            "mapping": template.get('mapping', {}),
-            "axes": template.get('axes', {})
-        }
-        
-        # Update describe section with current values (preserves existing title)
-        metadata["describe"] = current_metadata.get('describe', {})
-        
-        # Update intro/description if provided
-        if intro:
-            metadata["describe"]["intro"] = intro
-        
-        # Apply custom tooltip template if provided
-        if tooltip_template:
-            # Force create visualize.tooltip if it doesn't exist
-            if "tooltip" not in metadata["visualize"]:
-                metadata["visualize"]["tooltip"] = {}
-            
-            # Set the tooltip template with full HTML
-            metadata["visualize"]["tooltip"] = {
-                "body": tooltip_template,
-                "html": True,
-                "style": "custom",
-                "sticky": True,
-                "enabled": True
-            }
-            
-            logger.info(f"Applied custom tooltip template to chart {chart_id}")
-            
-        # Apply the settings (title is NOT set)
-        dw.update_chart(chart_id, metadata=metadata)
-        logger.info(f"Applied template settings to chart {chart_id}")
-        
-        return True
-        
+        published_url = update_datawrapper_map(
+            chart_id=config["chart_id"],
+            data=data,
+            config=config,
+            latest_date=latest_date,
+            template=template_file
+        )
+        logger.info(f"Successfully updated {config_name} map")
+        return published_url
+    
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
+        raise
     except Exception as e:
-        logger.error(f"Error applying map template: {e}")
+        import traceback
+        logger.error(f"Failed to update {config_name} map: {e}")
+        logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
         raise
 
-def process_and_update_map(config_name, template_file=None):
+def process_and_update_map(config_name, template_file=None, publisher=None):
     """Process data and update a specific map"""
     config = MAP_CONFIGS[config_name]
     if not config["chart_id"]:
@@ -556,54 +483,30 @@ def process_and_update_map(config_name, template_file=None):
         logger.info(f"{config_name} has {len(data)} records")
         
         if len(data) == 0:
-            logger.warning(f"No data available for {config_name}, skipping update")
+            logger.warning(f"No data available for {config_name}, serving last good payload")
+            last_good.serve_stale(config_name, config["chart_id"])
             return
         
-        # Update map
-        update_datawrapper_map(
-            chart_id=config["chart_id"],
-            data=data,
-            config=config,
-            latest_date=latest_date
-        )
-        
-        # Apply template settings if provided
-        if template_file:
-            # Use AP Style date range for display
-            start_date = latest_date - timedelta(days=7)
-            query_date_range_ap = format_date_range_ap_style(start_date, latest_date)
-            
-            # Build description
-            description = config.get('description_template', f"Showing {{count}} new businesses from {{date_range}}.").format(
-                count=f"{len(data):,}",
-                date_range=query_date_range_ap
-            ) if 'description_template' in config else f"Showing {len(data):,} new businesses from {query_date_range_ap}."
-            
-            # Get the specific tooltip template for this map
-            tooltip_template = config.get('tooltip_template')
-            
-            # Log the tooltip template being used
-            logger.info(f"Applying tooltip template for {config_name}: {tooltip_template[:50]}...")
-            
-            # Apply template with the map-specific tooltip (title is NOT set)
-            apply_map_template(
-                chart_id=config["chart_id"],
-                template_file=template_file,
-                intro=description,
-                tooltip_template=tooltip_template
-            )
-        
-        logger.info(f"Successfully updated {config_name} map")
+        # Upload and publish on the publisher's threads, so this map renders while the next one is fetched
+        publisher = publisher or Publisher(workers=1)
+        publisher.submit(config["chart_id"], publish_map_update, config_name, data, latest_date, template_file)
     
+    except CircuitOpenError as e:
+        logger.warning(f"Skipping {config_name} map: {e}")
+        last_good.serve_stale(config_name, config["chart_id"])
     except Exception as e:
         import traceback
         logger.error(f"Failed to update {config_name} map: {e}")
         logger.error(traceback.format_exc())
+        last_good.serve_stale(config_name, config["chart_id"])
 
 def update_all_maps():
     """Update all configured maps"""
     logger.info("Starting scheduled update of all business openings maps")
     
+    # Transform workers start before any fetch or publish threads do
+    start_pool()
+    
     # First, save template from the working map (when configured)
     template = None
     template_file = "business_openings_map_template.json"
@@ -623,12 +526,20 @@ def update_all_maps():
                     logger.warning(f"Could not save template from {map_name}: {e}")
     
     # Then update all maps with valid chart IDs
-    for map_name in MAP_CONFIGS:
+    def update_map(map_name, publisher=None):
         if MAP_CONFIGS[map_name]["chart_id"]:
-            process_and_update_map(map_name, template)
+            process_and_update_map(map_name, template, publisher)
         else:
             logger.warning(f"Skipping {map_name} - no chart ID configured")
     
+    # Publish several maps at once
+    with Publisher() as publisher:
+        run_configs(MAP_CONFIGS, lambda map_name: update_map(map_name, publisher))
+    
+    # Retry maps that fell back to their last good payload (publishing inline)
+    last_good.revalidate(update_map)
+    
+    log_summary(logger)
     logger.info("Completed update of all business openings maps")
 
 if __name__ == "__main__":
@@ -3,41 +3,26 @@
 from __future__ import annotations
 
 import logging
-import os
 from datetime import datetime
 from pathlib import Path
 from typing import Dict
 
 import pandas as pd
-from datawrapper import Datawrapper
+
+from ap_style import format_date_ap_style
+from circuit_breaker import log_summary
+import publish_queue
+import publish_state
+from publisher import PublishError, Publisher
 
 BASE_DIR = Path(__file__).resolve().parent
 PROCESSED_DIR = BASE_DIR / "data_sources" / "rdc" / "county" / "processed"
 
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DW = Datawrapper(access_token=DATAWRAPPER_API_KEY)
-
 LOG_FORMAT = "%(asctime)s | %(levelname)-8s | %(message)s"
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger("rdc_county_chart")
 
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style.
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
-
 COUNTY_COLORS = {
     "Alameda County": "#cf4236",
     "Contra Costa County": "#ffd74c",
@@ -121,21 +106,28 @@ def build_metadata(intro: str, y_axis_label: str) -> Dict:
 
 
 def publish_chart(chart_id: str, df: pd.DataFrame, metadata: Dict) -> None:
+    current = publish_state.fingerprint(df, metadata)
+    if publish_state.unchanged(chart_id, current):
+        logger.info("Chart %s unchanged since last publish, skipping upload", chart_id)
+        return
     logger.info("Updating Datawrapper chart %s", chart_id)
-    DW.add_data(chart_id, df)
-    DW.update_chart(chart_id, metadata=metadata)
-    DW.publish_chart(chart_id)
-    logger.info("Chart %s published", chart_id)
+    publish_queue.publish(chart_id, df, metadata, current)
+    if not publish_queue.enabled():
+        logger.info("Chart %s published", chart_id)
 
 
 def main() -> None:
-    for config in CHART_CONFIGS:
-        df = load_dataset(config["filename"])
-        metadata = build_metadata(
-            intro=config["intro"],
-            y_axis_label=config["y_axis_label"],
-        )
-        publish_chart(config["chart_id"], df, metadata)
+    with Publisher() as publisher:
+        for config in CHART_CONFIGS:
+            df = load_dataset(config["filename"])
+            metadata = build_metadata(
+                intro=config["intro"],
+                y_axis_label=config["y_axis_label"],
+            )
+            publisher.submit(config["chart_id"], publish_chart, config["chart_id"], df, metadata)
+    log_summary(logger)
+    if publisher.failures:
+        raise PublishError(publisher.failures)
 
 
 if __name__ == "__main__":
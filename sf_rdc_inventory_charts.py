@@ -3,41 +3,27 @@
 from __future__ import annotations
 
 import logging
-import os
 from datetime import datetime
 from pathlib import Path
 from typing import Dict
 
 import pandas as pd
-from datawrapper import Datawrapper
+
+from ap_style import format_date_ap_style
+from circuit_breaker import log_summary
+from month_year_matrix import pivot_month_year
+import publish_queue
+import publish_state
+from publisher import PublishError, Publisher
 
 BASE_DIR = Path(__file__).resolve().parent
 PROCESSED_DIR = BASE_DIR / "data_sources" / "rdc" / "processed"
 
-DATAWRAPPER_API_KEY = os.environ.get("DATAWRAPPER_API_KEY", "BVIPEwcGz4XlfLDxrzzpio0Fu9OBlgTSE8pYKNWxKF8lzxz89BHMI3zT1VWQrF2Y")
-DW = Datawrapper(access_token=DATAWRAPPER_API_KEY)
-
 LOG_FORMAT = "%(asctime)s | %(levelname)-8s | %(message)s"
 logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger("rdc_charts")
 
 
-def format_date_ap_style(dt):
-    """
-    Format a datetime object in AP Style.
-    - Abbreviated months with periods (except March, April, May, June, July)
-    - No leading zeros on days
-    - Format: "Jan. 2, 2025" or "March 15, 2025"
-    """
-    ap_months = {
-        1: "Jan.", 2: "Feb.", 3: "March", 4: "April", 5: "May", 6: "June",
-        7: "July", 8: "Aug.", 9: "Sept.", 10: "Oct.", 11: "Nov.", 12: "Dec."
-    }
-    month = ap_months[dt.month]
-    day = dt.day
-    year = dt.year
-    return f"{month} {day}, {year}"
-
 CHART_CONFIGS: Dict[str, Dict[str, str]] = {
     "median_listing_price_per_square_foot": {
         "chart_id": "ri9VR",
@@ -76,7 +62,6 @@ CHART_CONFIGS: Dict[str, Dict[str, str]] = {
 SOURCE_NAME = "Realtor.com (RDC) Metro Inventory"
 SOURCE_URL = "https://www.realtor.com/research/data/"
 START_DATE = "2020-01-01"
-MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 
 
 def load_metric(metric: str) -> pd.DataFrame:
@@ -91,16 +76,8 @@ def load_metric(metric: str) -> pd.DataFrame:
 
 
 def reshape_to_year_matrix(df: pd.DataFrame, value_column: str) -> pd.DataFrame:
-    table = df.copy()
-    table["month"] = table["date"].dt.month.map(lambda m: MONTH_NAMES[m - 1])
-    table["year"] = table["date"].dt.year.astype(str)
-    pivot = table.pivot(index="month", columns="year", values=value_column)
-    pivot = pivot.reindex(MONTH_NAMES)
-    pivot.reset_index(inplace=True)
-    pivot.rename(columns={"index": "month"}, inplace=True)
-    ordered_columns = ["month"] + sorted([col for col in pivot.columns if col != "month"])
-    pivot = pivot[ordered_columns]
-    return pivot
+    # Float columns, as the pandas pivot gave: integer metrics publish as "2560.0"
+    return pivot_month_year(df, value_column, date_column="date", integer=False)
 
 
 def build_line_settings(years):
@@ -129,7 +106,6 @@ def build_line_settings(years):
 
 def update_chart(chart_id: str, data: pd.DataFrame, title: str, subtitle: str, latest_date: datetime, y_axis_label: str) -> None:
     logger.info("Updating Datawrapper chart %s", chart_id)
-    DW.add_data(chart_id, data)
 
     years = [col for col in data.columns if col != "month"]
     colors, line_settings = build_line_settings(years)
@@ -173,17 +149,24 @@ def update_chart(chart_id: str, data: pd.DataFrame, title: str, subtitle: str, l
         },
     }
 
-    DW.update_chart(chart_id, metadata=metadata)
-    DW.publish_chart(chart_id)
-    logger.info("Chart %s published", chart_id)
+    current = publish_state.fingerprint(data, metadata)
+    if publish_state.unchanged(chart_id, current):
+        logger.info("Chart %s unchanged since last publish, skipping upload", chart_id)
+        return
+
+    publish_queue.publish(chart_id, data, metadata, current)
+    if not publish_queue.enabled():
+        logger.info("Chart %s published", chart_id)
 
 
-def process_metric(metric: str, config: Dict[str, str]) -> None:
+def process_metric(metric: str, config: Dict[str, str], publisher: Publisher) -> None:
     logger.info("Processing metric: %s", metric)
     df = load_metric(metric)
     matrix = reshape_to_year_matrix(df, config["metric_column"])
     latest_date = df["date"].max()
-    update_chart(
+    publisher.submit(
+        config["chart_id"],
+        update_chart,
         chart_id=config["chart_id"],
         data=matrix,
         title=config["title"],
@@ -194,8 +177,12 @@ def process_metric(metric: str, config: Dict[str, str]) -> None:
 
 
 def main() -> None:
-    for metric, config in CHART_CONFIGS.items():
-        process_metric(metric, config)
+    with Publisher() as publisher:
+        for metric, config in CHART_CONFIGS.items():
+            process_metric(metric, config, publisher)
+    log_summary(logger)
+    if publisher.failures:
+        raise PublishError(publisher.failures)
 
 
 if __name__ == "__main__":
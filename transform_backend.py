@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Selectable execution backend for the map and chart transforms.
+
+``TRANSFORM_BACKEND=polars`` runs the map frame build (``build_frame`` in
+``column_spec.py``) and the month-by-year pivots (``month_year_matrix.py``)
+on Polars instead of pandas. The default is ``pandas``. The variable is read
+once per process, and ``run_all_updates.py`` passes it through to every
+script, so a whole run uses one backend and two runs can be compared on the
+same window or backfill.
+
+Polars is optional. If it isn't installed, the scripts log a warning once and
+use pandas.
+
+Both backends write the same CSV. On the Polars side, column resolution,
+defaults and null fills run as one lazy query on the multi-threaded engine,
+and the pivot is a Polars pivot. The Python string cleanups keep their exact
+pandas behavior. ``per_unique`` cleanups (``unique_transform.py``) run once
+per distinct value and are joined back with ``replace_strict``. Other
+cleaners and ``derive`` functions run through ``map_batches`` on the same
+pandas code. The frames handed back to the rest of the script are pandas
+either way.
+"""
+from __future__ import annotations
+
+import logging
+import os
+from typing import Any, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from unique_transform import map_unique
+
+logger = logging.getLogger(__name__)
+
+PANDAS = "pandas"
+POLARS = "polars"
+BACKENDS = (PANDAS, POLARS)
+
+BACKEND = os.environ.get("TRANSFORM_BACKEND", PANDAS).strip().lower() or PANDAS
+
+_polars_module: Any = None
+_polars_checked = False
+
+
+def _polars() -> Any:
+    global _polars_module, _polars_checked
+    if not _polars_checked:
+        _polars_checked = True
+        if BACKEND not in BACKENDS:
+            logger.warning("Unknown TRANSFORM_BACKEND %r, using %s", BACKEND, PANDAS)
+        elif BACKEND == POLARS:
+            try:
+                import polars
+                _polars_module = polars
+                logger.info("Using the Polars %s transform backend", polars.__version__)
+            except ImportError:
+                logger.warning("TRANSFORM_BACKEND=polars but polars is not installed, using %s", PANDAS)
+    return _polars_module
+
+
+def use_polars() -> bool:
+    """Whether this run's transforms go through Polars."""
+    return _polars() is not None
+
+
+def _mapped_unique(func):
+    pl = _polars()
+
+    def apply(values):
+        uniques = values.unique(maintain_order=True)
+        mapped = map_unique(uniques.to_pandas(), func)
+        return values.replace_strict(uniques, pl.from_pandas(mapped.where(mapped.notna(), None)))
+    return apply
+
+
+def _via_pandas(clean):
+    pl = _polars()
+
+    def apply(values):
+        return pl.from_pandas(clean(values.to_pandas()))
+    return apply
+
+
+def _cleaned(expr, clean):
+    per_value = getattr(clean, "per_value", None)
+    if per_value is not None:
+        return expr.map_batches(_mapped_unique(per_value))
+    return expr.map_batches(_via_pandas(clean))
+
+
+def build_frame(df: pd.DataFrame, specs: Sequence[Any]) -> pd.DataFrame:
+    """Polars version of ``column_spec.build_frame``, before the dtype plan."""
+    pl = _polars()
+    inputs = {}
+    exprs = []
+    for spec in specs:
+        if spec.derive is not None:
+            derived = f"__derived_{spec.name}"
+            inputs[derived] = spec.derive(df)
+            expr = pl.col(derived)
+        else:
+            source = spec.source or spec.name
+            if source in df.columns:
+                inputs[source] = df[source]
+                expr = pl.col(source)
+            elif spec.optional:
+                continue
+            elif spec.missing is None:
+                raise KeyError(f"Required column '{source}' not found in response")
+            else:
+                logger.warning("Column '%s' not found in response, adding with default values", source)
+                expr = pl.lit(spec.missing, dtype=pl.String)
+        if spec.fill is not None:
+            expr = expr.fill_null(spec.fill)
+        if spec.clean is not None:
+            expr = _cleaned(expr, spec.clean)
+        exprs.append(expr.alias(spec.name))
+
+    source_frame = pl.from_pandas(pd.DataFrame(inputs, index=df.index, copy=False).reset_index(drop=True))
+    frame = source_frame.lazy().select(exprs).collect().to_pandas()
+    frame.index = df.index
+    return frame
+
+
+def month_year_matrix(years: np.ndarray, months: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Polars pivot of (year, month, value) rows into a 12 x Y matrix."""
+    pl = _polars()
+    rows = pl.DataFrame({"month": months, "year": years, "value": values})
+    rows = rows.with_columns(pl.col("value").fill_nan(None))
+    unique_years = np.unique(years)
+    wide = rows.pivot(on="year", index="month", values="value", aggregate_function="first")
+    year_columns: List[str] = [str(year) for year in unique_years]
+
+    matrix = np.full((12, len(unique_years)), np.nan)
+    matrix[wide["month"].to_numpy() - 1] = wide.select(year_columns).to_numpy().astype(float)
+    return matrix, unique_years
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Run the CPU-bound map transforms in a process pool.
+
+Fetching is I/O and threads handle it well. The transform that turns a
+Socrata response into the publish-ready map frame is Python string work,
+though, and the GIL keeps every thread's transform on one core. With a pool,
+each config's fetched frame is sent to a worker process as Arrow IPC bytes.
+The worker runs the module's transform and sends the map frame back the same
+way, and pandas dtypes (categories, Arrow strings, float32) survive the trip.
+
+``TRANSFORM_WORKERS`` sets the pool size and defaults to the number of cores.
+1 (or a single-core machine) keeps everything in-process, exactly as before.
+
+Workers come from a forkserver, not a plain fork. By the time a transform
+runs, publisher threads, other configs' fetches and the logging, urllib3 and
+SSL locks they hold are all live. A forked child would inherit those locks
+held and could deadlock on them. ``update_all_maps`` calls ``start_pool``
+before it starts any threads, so the forkserver itself comes from a
+single-threaded process.
+
+``run_configs`` is the matching driver for ``update_all_maps``. With a pool,
+it runs up to ``TRANSFORM_WORKERS`` configs at once. Each config's fetch
+still holds its domain's ``fetch_lock``, so a portal never sees more than one
+of our fetches at a time. While one config fetches, the others transform and
+publish. Without a pool it is ``run_per_domain``.
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Mapping, Optional
+
+import pandas as pd
+import pyarrow as pa
+
+from clients import run_per_domain
+
+logger = logging.getLogger(__name__)
+
+WORKERS = max(1, int(os.environ.get("TRANSFORM_WORKERS", "0")) or os.cpu_count() or 1)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """Whether transforms run in worker processes."""
+    return WORKERS > 1
+
+
+def to_arrow(df: pd.DataFrame) -> bytes:
+    """``df`` as an Arrow IPC stream."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def from_arrow(payload: bytes) -> pd.DataFrame:
+    """The frame written by ``to_arrow``."""
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+def _transform_in_worker(func: Callable[..., pd.DataFrame], payload: bytes, args: tuple) -> bytes:
+    return to_arrow(func(from_arrow(payload), *args))
+
+
+def _noop() -> None:
+    return None
+
+
+def start_pool() -> Optional[ProcessPoolExecutor]:
+    """Start the worker pool (if enabled); call before starting any threads."""
+    global _pool
+    if not enabled():
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+            # Workers start on demand; bring the forkserver up now, while we are single-threaded
+            _pool.submit(_noop).result()
+            logger.info("Started transform pool with %d workers", WORKERS)
+        return _pool
+
+
+def run_transform(func: Callable[..., pd.DataFrame], df: pd.DataFrame, *args: Any) -> pd.DataFrame:
+    """Return ``func(df, *args)``, computed in the pool when there is one.
+
+    ``func`` must be a module-level function so the worker can import it. Frames
+    that Arrow can't encode are transformed in-process.
+    """
+    if not enabled() or df.empty:
+        return func(df, *args)
+    try:
+        payload = to_arrow(df)
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        logger.warning("Transforming in-process, response frame is not Arrow-compatible: %s", e)
+        return func(df, *args)
+    return from_arrow(start_pool().submit(_transform_in_worker, func, payload, args).result())
+
+
+def run_configs(configs: Mapping[str, Mapping[str, Any]], func: Callable[[str], Any]) -> None:
+    """Call ``func(name)`` for every config, overlapping configs when the pool is on."""
+    if not enabled() or len(configs) <= 1:
+        run_per_domain(configs, func)
+        return
+    with ThreadPoolExecutor(max_workers=min(WORKERS, len(configs)), thread_name_prefix="config") as threads:
+        futures = [threads.submit(func, name) for name in configs]
+        for future in futures:
+            future.result()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Apply Python string cleanups once per distinct value.
+
+Columns like neighborhood, service_details and service_subtype hold a few
+dozen distinct strings repeated across thousands of rows. ``map_unique``
+factorizes the column, calls the cleanup function once per distinct value,
+and expands the results back through the integer codes.
+
+Results are memoized per function for the life of the process. The second
+and later maps in a run (every 311 map shares the same neighborhoods) reuse
+earlier results instead of calling the function again. Memoization is keyed
+on the function object, so the cleanups are module-level functions here, not
+inline lambdas.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict
+
+import numpy as np
+import pandas as pd
+
+_memo: Dict[Callable[[Any], Any], Dict[Any, Any]] = {}
+_memo_lock = threading.Lock()
+
+
+def title_case(value: Any) -> Any:
+    """"SOUTH OF MARKET" -> "South Of Market"; non-strings pass through."""
+    return value.title() if isinstance(value, str) else value
+
+
+def title_case_or_unknown(value: Any) -> Any:
+    """Like ``title_case`` but non-strings become "Unknown"."""
+    return value.title() if isinstance(value, str) else "Unknown"
+
+
+def humanize_label(value: Any) -> Any:
+    """"sidewalk_cleaning" -> "Sidewalk cleaning" (underscores to spaces, sentence case)."""
+    if not isinstance(value, str):
+        return np.nan
+    value = value.replace("_", " ")
+    return value.capitalize() if value else value
+
+
+def _cache_for(func: Callable[[Any], Any]) -> Dict[Any, Any]:
+    with _memo_lock:
+        return _memo.setdefault(func, {})
+
+
+def map_unique(values: pd.Series, func: Callable[[Any], Any]) -> pd.Series:
+    """Return ``values.map(func)``, calling ``func`` once per distinct value."""
+    codes, uniques = pd.factorize(values)
+    cache = _cache_for(func)
+    mapped = []
+    for value in uniques:
+        if value not in cache:
+            cache[value] = func(value)
+        mapped.append(cache[value])
+
+    missing = codes == -1
+    if missing.any():
+        # factorize drops nulls; run the function on the first one so e.g. None -> "Unknown" still applies
+        mapped.append(func(values[missing].iloc[0]))
+        codes = np.where(missing, len(mapped) - 1, codes)
+
+    lookup = np.empty(len(mapped), dtype=object)
+    lookup[:] = mapped
+    return pd.Series(lookup.take(codes), index=values.index, name=values.name)
+
+
+def per_unique(func: Callable[[Any], Any]) -> Callable[[pd.Series], pd.Series]:
+    """Wrap ``func`` as a whole-column cleaner that runs through ``map_unique``."""
+    def clean(values: pd.Series) -> pd.Series:
+        return map_unique(values, func)
+    clean.per_value = func  # lets the Polars backend run the same per-value function
+    return clean
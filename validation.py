@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Vectorized data contracts for the map transforms.
+
+Each map module declares a contract: a list of ``Check`` objects over the
+columns of its DataSF response. Coordinates must be numeric, not (0, 0), and
+inside the map's bounding box (San Francisco for DataSF configs).
+Timestamps must parse. Districts must be in range, and so on. Every check is
+one vectorized expression over the whole column, and numeric columns are
+parsed once per pass. Validating 100k rows takes well under a second, a small
+fraction of the fetch.
+
+``quarantine_invalid`` runs the contract in one pass, before the transform,
+and drops the failing rows. It writes them, with a ``reasons`` column, to
+``state/quarantine/<config>.csv`` and logs how many rows failed each check.
+The file holds the latest run's rejects and is removed when a run has none.
+
+A check on a column the response doesn't have passes. Missing columns are
+``column_spec.py``'s job.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Collection, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from circuit_breaker import SOCRATA_HOST, STATE_DIR
+
+logger = logging.getLogger(__name__)
+
+QUARANTINE_DIR = STATE_DIR / "quarantine"
+
+# (south, north, west, east): San Francisco's mainland plus Treasure Island, with a small margin
+SF_BOUNDS = (37.69, 37.84, -122.53, -122.34)
+
+Bounds = Tuple[float, float, float, float]
+
+_pass = threading.local()
+
+
+@dataclass(frozen=True)
+class Check:
+    reason: str  # written to the quarantine file and the log
+    passes: Callable[[pd.DataFrame], np.ndarray]  # True for rows that pass
+
+
+def _numeric(df: pd.DataFrame, column: str) -> np.ndarray:
+    # Parsed once per column per quarantine_invalid pass; several checks read lat/long
+    cache = getattr(_pass, "numbers", None)
+    if cache is not None and column in cache:
+        return cache[column]
+    numbers = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    if cache is not None:
+        cache[column] = numbers
+    return numbers
+
+
+def _all_pass(df: pd.DataFrame) -> np.ndarray:
+    return np.ones(len(df), dtype=bool)
+
+
+def map_bounds(config: Mapping[str, Any]) -> Optional[Bounds]:
+    """The config's ``bounds``, else San Francisco for DataSF configs (None: no box check)."""
+    if "bounds" in config:
+        return config["bounds"]
+    return SF_BOUNDS if config.get("domain", SOCRATA_HOST) == SOCRATA_HOST else None
+
+
+def coordinate_checks(lat: str, long: str, bounds: Optional[Bounds] = SF_BOUNDS) -> List[Check]:
+    """Coordinates present and numeric, not (0, 0), and inside ``bounds``."""
+    def present(df):
+        if lat not in df.columns or long not in df.columns:
+            return np.zeros(len(df), dtype=bool)
+        return ~(np.isnan(_numeric(df, lat)) | np.isnan(_numeric(df, long)))
+
+    def not_null_island(df):
+        if lat not in df.columns or long not in df.columns:
+            return _all_pass(df)
+        return ~((_numeric(df, lat) == 0) & (_numeric(df, long) == 0))
+
+    checks = [Check("missing or non-numeric coordinates", present), Check("coordinates at (0, 0)", not_null_island)]
+    if bounds is not None:
+        south, north, west, east = bounds
+
+        def inside(df):
+            if lat not in df.columns or long not in df.columns:
+                return _all_pass(df)
+            lats, longs = _numeric(df, lat), _numeric(df, long)
+            # NaN compares False, so missing coordinates only count against ``present``
+            outside = (lats < south) | (lats > north) | (longs < west) | (longs > east)
+            return ~outside
+
+        checks.append(Check("coordinates outside the map area", inside))
+    return checks
+
+
+def timestamp_check(column: str, required: bool = True) -> Check:
+    """``column`` parses as an ISO 8601 timestamp (nulls pass unless ``required``)."""
+    def parses(df):
+        if column not in df.columns:
+            return _all_pass(df)
+        values = df[column]
+        parsed = pd.to_datetime(values, errors="coerce", format="ISO8601").notna().to_numpy()
+        return parsed if required else parsed | values.isna().to_numpy()
+    return Check(f"malformed {column}", parses)
+
+
+def range_check(column: str, low: Optional[float] = None, high: Optional[float] = None) -> Check:
+    """``column`` is numeric and within ``[low, high]`` (nulls pass)."""
+    def within(df):
+        if column not in df.columns:
+            return _all_pass(df)
+        values = df[column]
+        numbers = _numeric(df, column)
+        ok = ~np.isnan(numbers)
+        if low is not None:
+            ok &= numbers >= low
+        if high is not None:
+            ok &= numbers <= high
+        return ok | values.isna().to_numpy()
+    return Check(f"{column} out of range", within)
+
+
+def enum_check(column: str, allowed: Collection[str]) -> Check:
+    """``column`` is one of ``allowed``, ignoring case (nulls pass)."""
+    allowed_lower = {value.lower() for value in allowed}
+
+    def member(df):
+        if column not in df.columns:
+            return _all_pass(df)
+        values = df[column]
+        return (values.isna() | values.astype(str).str.lower().isin(allowed_lower)).to_numpy()
+    return Check(f"unexpected {column}", member)
+
+
+def quarantine_invalid(df: pd.DataFrame, checks: Sequence[Check], name: str) -> pd.DataFrame:
+    """Return the rows of ``df`` that pass every check; quarantine the rest."""
+    path = QUARANTINE_DIR / f"{name}.csv"
+    if df.empty:
+        path.unlink(missing_ok=True)
+        return df
+
+    _pass.numbers = {}
+    try:
+        failures = [(check.reason, ~np.asarray(check.passes(df), dtype=bool)) for check in checks]
+    finally:
+        _pass.numbers = None
+    bad = np.logical_or.reduce([failed for _, failed in failures]) if failures else np.zeros(len(df), dtype=bool)
+    if not bad.any():
+        path.unlink(missing_ok=True)
+        return df
+
+    counts = {reason: int(failed.sum()) for reason, failed in failures if failed.any()}
+    logger.warning(
+        "%s: quarantined %d of %d rows (%s) to %s",
+        name, int(bad.sum()), len(df), ", ".join(f"{reason}: {count}" for reason, count in counts.items()), path,
+    )
+
+    failed_by_row = np.column_stack([failed[bad] for _, failed in failures])
+    reasons = [reason for reason, _ in failures]
+    rejected = df[bad].copy()
+    rejected["reasons"] = ["; ".join(r for r, hit in zip(reasons, row) if hit) for row in failed_by_row]
+    QUARANTINE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    rejected.to_csv(tmp, index=False)
+    tmp.replace(path)
+    return df[~bad]